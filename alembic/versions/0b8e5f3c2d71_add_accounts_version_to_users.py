@@ -0,0 +1,26 @@
+"""Add accounts_version to users
+
+Revision ID: 0b8e5f3c2d71
+Revises: f7c3d1a6b284
+Create Date: 2026-10-18 15:40:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0b8e5f3c2d71'
+down_revision: Union[str, None] = 'f7c3d1a6b284'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('users', sa.Column('accounts_version', sa.Integer(), server_default='0', nullable=False))
+
+
+def downgrade() -> None:
+    op.drop_column('users', 'accounts_version')
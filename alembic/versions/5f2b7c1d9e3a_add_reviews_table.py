@@ -0,0 +1,52 @@
+"""Add reviews table
+
+Revision ID: 5f2b7c1d9e3a
+Revises: d9a0004a16bd
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5f2b7c1d9e3a'
+down_revision: Union[str, None] = 'd9a0004a16bd'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'reviews',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('business_id', sa.String(), nullable=False),
+        sa.Column('feedback_id', sa.BigInteger(), nullable=False),
+        sa.Column('author', sa.String(), nullable=True),
+        sa.Column('advantages', sa.Text(), nullable=True),
+        sa.Column('disadvantages', sa.Text(), nullable=True),
+        sa.Column('comment', sa.Text(), nullable=True),
+        sa.Column('rating', sa.Integer(), nullable=True),
+        sa.Column('order_id', sa.BigInteger(), nullable=True),
+        sa.Column('photos', sa.JSON(), nullable=True),
+        sa.Column('created_at', sa.DateTime(timezone=True), nullable=False),
+        sa.Column('reaction_status', sa.String(), nullable=True),
+        sa.Column('synced_at', sa.DateTime(timezone=True), nullable=True),
+        sa.Column('offer_id', sa.String(), nullable=True),
+        sa.Column('offer_name', sa.String(), nullable=True),
+        sa.Column('placement_type', sa.String(), nullable=True),
+        sa.Column('enriched', sa.Boolean(), nullable=False, server_default=sa.false()),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('business_id', 'feedback_id', name='uq_reviews_business_feedback')
+    )
+    op.create_index(op.f('ix_reviews_id'), 'reviews', ['id'], unique=False)
+    op.create_index('ix_reviews_business_status_created', 'reviews',
+                    ['business_id', 'reaction_status', 'created_at', 'id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_reviews_business_status_created', table_name='reviews')
+    op.drop_index(op.f('ix_reviews_id'), table_name='reviews')
+    op.drop_table('reviews')
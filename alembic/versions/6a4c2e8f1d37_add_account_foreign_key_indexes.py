@@ -0,0 +1,28 @@
+"""Add indexes on campaigns.marketplace_account_id and marketplace_accounts.user_id
+
+Revision ID: 6a4c2e8f1d37
+Revises: 3d9a6e4b7f15
+Create Date: 2026-10-18 18:40:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '6a4c2e8f1d37'
+down_revision: Union[str, None] = '3d9a6e4b7f15'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index(op.f('ix_campaigns_marketplace_account_id'), 'campaigns', ['marketplace_account_id'], unique=False)
+    op.create_index(op.f('ix_marketplace_accounts_user_id'), 'marketplace_accounts', ['user_id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_marketplace_accounts_user_id'), table_name='marketplace_accounts')
+    op.drop_index(op.f('ix_campaigns_marketplace_account_id'), table_name='campaigns')
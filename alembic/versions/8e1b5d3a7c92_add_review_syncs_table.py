@@ -0,0 +1,36 @@
+"""Add review_syncs table
+
+Revision ID: 8e1b5d3a7c92
+Revises: 6a4c2e8f1d37
+Create Date: 2026-10-18 20:10:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8e1b5d3a7c92'
+down_revision: Union[str, None] = '6a4c2e8f1d37'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'review_syncs',
+        sa.Column('business_id', sa.String(), nullable=False),
+        sa.Column('synced_at', sa.DateTime(timezone=True), nullable=False),
+        sa.PrimaryKeyConstraint('business_id')
+    )
+    # Бизнесы, отзывы которых уже загружались, не должны снова идти через живой запрос
+    op.execute(
+        "INSERT INTO review_syncs (business_id, synced_at) "
+        "SELECT business_id, COALESCE(MAX(synced_at), now()) FROM reviews GROUP BY business_id"
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('review_syncs')
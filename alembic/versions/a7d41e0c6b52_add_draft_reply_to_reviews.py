@@ -0,0 +1,28 @@
+"""Add draft_reply to reviews
+
+Revision ID: a7d41e0c6b52
+Revises: 5f2b7c1d9e3a
+Create Date: 2026-10-18 12:30:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a7d41e0c6b52'
+down_revision: Union[str, None] = '5f2b7c1d9e3a'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('reviews', sa.Column('draft_reply', sa.Text(), nullable=True))
+    op.add_column('reviews', sa.Column('draft_generated_at', sa.DateTime(timezone=True), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('reviews', 'draft_generated_at')
+    op.drop_column('reviews', 'draft_reply')
@@ -0,0 +1,41 @@
+"""Add order_offer_cache table
+
+Revision ID: b3e9f2a81c07
+Revises: a7d41e0c6b52
+Create Date: 2026-10-18 13:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b3e9f2a81c07'
+down_revision: Union[str, None] = 'a7d41e0c6b52'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'order_offer_cache',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('business_id', sa.String(), nullable=False),
+        sa.Column('order_id', sa.BigInteger(), nullable=False),
+        sa.Column('campaign_id', sa.BigInteger(), nullable=False),
+        sa.Column('offer_id', sa.String(), nullable=True),
+        sa.Column('offer_name', sa.String(), nullable=True),
+        sa.Column('placement_type', sa.String(), nullable=True),
+        sa.Column('found', sa.Boolean(), nullable=False),
+        sa.Column('fetched_at', sa.DateTime(timezone=True), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('business_id', 'order_id', 'campaign_id', name='uq_order_offer_cache_key')
+    )
+    op.create_index(op.f('ix_order_offer_cache_id'), 'order_offer_cache', ['id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_order_offer_cache_id'), table_name='order_offer_cache')
+    op.drop_table('order_offer_cache')
@@ -0,0 +1,26 @@
+"""Add index on reply_cache.created_at
+
+Revision ID: b4e7c1a9d256
+Revises: 8e1b5d3a7c92
+Create Date: 2026-10-18 20:10:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b4e7c1a9d256'
+down_revision: Union[str, None] = '8e1b5d3a7c92'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index(op.f('ix_reply_cache_created_at'), 'reply_cache', ['created_at'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_reply_cache_created_at'), table_name='reply_cache')
@@ -0,0 +1,26 @@
+"""Add order_hits to campaigns
+
+Revision ID: c58d0a3f4e19
+Revises: b3e9f2a81c07
+Create Date: 2026-10-18 13:30:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c58d0a3f4e19'
+down_revision: Union[str, None] = 'b3e9f2a81c07'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('campaigns', sa.Column('order_hits', sa.Integer(), server_default='0', nullable=False))
+
+
+def downgrade() -> None:
+    op.drop_column('campaigns', 'order_hits')
@@ -0,0 +1,37 @@
+"""Add reply_cache table
+
+Revision ID: d1f6b8e2a943
+Revises: c58d0a3f4e19
+Create Date: 2026-10-18 14:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd1f6b8e2a943'
+down_revision: Union[str, None] = 'c58d0a3f4e19'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'reply_cache',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('key_hash', sa.String(length=64), nullable=False),
+        sa.Column('reply', sa.Text(), nullable=False),
+        sa.Column('created_at', sa.DateTime(timezone=True), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_reply_cache_id'), 'reply_cache', ['id'], unique=False)
+    op.create_index(op.f('ix_reply_cache_key_hash'), 'reply_cache', ['key_hash'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_reply_cache_key_hash'), table_name='reply_cache')
+    op.drop_index(op.f('ix_reply_cache_id'), table_name='reply_cache')
+    op.drop_table('reply_cache')
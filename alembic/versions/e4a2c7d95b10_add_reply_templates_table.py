@@ -0,0 +1,40 @@
+"""Add reply_templates table
+
+Revision ID: e4a2c7d95b10
+Revises: d1f6b8e2a943
+Create Date: 2026-10-18 14:30:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e4a2c7d95b10'
+down_revision: Union[str, None] = 'd1f6b8e2a943'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'reply_templates',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('company_id', sa.Integer(), nullable=True),
+        sa.Column('min_rating', sa.Integer(), nullable=True),
+        sa.Column('max_rating', sa.Integer(), nullable=True),
+        sa.Column('product_name', sa.String(), nullable=True),
+        sa.Column('text', sa.Text(), nullable=False),
+        sa.ForeignKeyConstraint(['company_id'], ['companies.id'], ),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_reply_templates_company_id'), 'reply_templates', ['company_id'], unique=False)
+    op.create_index(op.f('ix_reply_templates_id'), 'reply_templates', ['id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_reply_templates_id'), table_name='reply_templates')
+    op.drop_index(op.f('ix_reply_templates_company_id'), table_name='reply_templates')
+    op.drop_table('reply_templates')
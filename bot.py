@@ -2,25 +2,104 @@
 # bot.py
 
 import os
+import asyncio
 import aiohttp
+from aiohttp import web
 import json
 import re
-from aiogram import Bot, Dispatcher, types, executor
+import time
+from typing import Optional
+from aiogram import Dispatcher, types, executor
 from aiogram.types import BotCommand, ParseMode, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, InputMediaPhoto, MediaGroup
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram.dispatcher.webhook import WebhookRequestHandler
+from aiogram.utils.executor import Executor
+from aiogram.utils.exceptions import MessageNotModified, RetryAfter
+from ttl_cache import TTLCache
+from media_registry import MediaRegistry
+from fsm_storage import PostgresStorage
+from update_workers import UpdateWorkerPool, AdvisoryUserLock
+from send_scheduler import ScheduledBot, SendScheduler
 
 # Получаем переменные окружения
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
 BACKEND_URL = os.getenv('BACKEND_URL', 'http://backend:8000')
 EXTERNAL_BACKEND_URL = os.getenv('EXTERNAL_BACKEND_URL')
 BOT_USERNAME = os.getenv('BOT_USERNAME')
+# Не чаще одной правки сообщения с ответом за этот интервал (секунды)
+REPLY_EDIT_INTERVAL = float(os.getenv('REPLY_EDIT_INTERVAL', '1.0'))
+
+# Пул соединений к бэкенду и таймауты запросов (секунды)
+BACKEND_POOL_SIZE = int(os.getenv('BACKEND_POOL_SIZE', '100'))
+BACKEND_KEEPALIVE = float(os.getenv('BACKEND_KEEPALIVE', '30'))
+BACKEND_CONNECT_TIMEOUT = float(os.getenv('BACKEND_CONNECT_TIMEOUT', '5'))
+BACKEND_TIMEOUT = float(os.getenv('BACKEND_TIMEOUT', '10'))
+# Отправка ответа включает повторы запросов к Маркету
+BACKEND_SEND_TIMEOUT = float(os.getenv('BACKEND_SEND_TIMEOUT', '60'))
+# Поток генерации: ограничиваем паузу между событиями, а не весь поток
+BACKEND_STREAM_READ_TIMEOUT = float(os.getenv('BACKEND_STREAM_READ_TIMEOUT', '60'))
+# Режим получения апдейтов: polling (по умолчанию) или webhook
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+# Пропускать ли накопившиеся за время перезапуска апдейты (только polling)
+SKIP_UPDATES = os.getenv('SKIP_UPDATES', '0') == '1'
+# Webhook: публичный адрес, локальный HTTP-сервер и пул обработчиков
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST')  # например, https://bot.example.com
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))
+WEBAPP_HOST = os.getenv('WEBAPP_HOST', '0.0.0.0')
+WEBAPP_PORT = int(os.getenv('WEBAPP_PORT', '8080'))
+UPDATE_WORKERS = int(os.getenv('UPDATE_WORKERS', '16'))
+UPDATE_QUEUE_SIZE = int(os.getenv('UPDATE_QUEUE_SIZE', '100'))
+# Куда сохранять апдейты, не обработанные к остановке (обрабатываются при следующем запуске)
+UPDATE_BACKLOG_DIR = os.getenv('UPDATE_BACKLOG_DIR', 'data/update_backlog')
+# Лимиты исходящих сообщений Telegram (в секунду)
+TELEGRAM_GLOBAL_RATE = float(os.getenv('TELEGRAM_GLOBAL_RATE', '30'))
+TELEGRAM_CHAT_RATE = float(os.getenv('TELEGRAM_CHAT_RATE', '1'))
+TELEGRAM_CHAT_BURST = float(os.getenv('TELEGRAM_CHAT_BURST', '3'))
+# Где хранить file_id загруженных в Telegram картинок
+MEDIA_REGISTRY_PATH = os.getenv('MEDIA_REGISTRY_PATH', 'data/media_registry.json')
+# Хранилище состояний: postgres (переживает перезапуск) или memory
+FSM_STORAGE = os.getenv('FSM_STORAGE', 'postgres')
+# Сколько реплик бота работает одновременно; при нескольких состояние читается
+# и пишется в Postgres без локального кэша и отложенной записи, а апдейты
+# одного пользователя обрабатываются под advisory lock в Postgres
+BOT_REPLICAS = int(os.getenv('BOT_REPLICAS', '1'))
+FSM_FLUSH_INTERVAL = float(os.getenv('FSM_FLUSH_INTERVAL', '0.2'))
+FSM_CACHE_TTL = float(os.getenv('FSM_CACHE_TTL', '5'))
+DB_USER = os.getenv('DB_USER', 'your_db_user')
+DB_PASSWORD = os.getenv('DB_PASSWORD', 'your_db_password')
+DB_NAME = os.getenv('DB_NAME', 'your_db_name')
+DB_HOST = os.getenv('DB_HOST', 'db')
+DB_PORT = os.getenv('DB_PORT', '5432')
+# Кэш списка кабинетов пользователя (секунды / число пользователей)
+ACCOUNTS_CACHE_TTL = float(os.getenv('ACCOUNTS_CACHE_TTL', '600'))
+ACCOUNTS_CACHE_SIZE = int(os.getenv('ACCOUNTS_CACHE_SIZE', '10000'))
 
 if not TELEGRAM_TOKEN:
     raise ValueError("Необходимо установить переменную окружения TELEGRAM_TOKEN")
 
-bot = Bot(token=TELEGRAM_TOKEN)
-storage = MemoryStorage()
+# Все отправки и правки сообщений идут через общую очередь с лимитами Telegram
+send_scheduler = SendScheduler(global_rate=TELEGRAM_GLOBAL_RATE, chat_rate=TELEGRAM_CHAT_RATE,
+                               chat_burst=TELEGRAM_CHAT_BURST)
+bot = ScheduledBot(token=TELEGRAM_TOKEN, scheduler=send_scheduler)
+if FSM_STORAGE == 'memory':
+    storage = MemoryStorage()
+else:
+    storage = PostgresStorage(
+        f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}",
+        flush_interval=FSM_FLUSH_INTERVAL,
+        cache_ttl=FSM_CACHE_TTL,
+        shared=BOT_REPLICAS > 1,
+    )
 dp = Dispatcher(bot, storage=storage)
+media_registry = MediaRegistry(MEDIA_REGISTRY_PATH)
+update_pool = UpdateWorkerPool(
+    dp, workers=UPDATE_WORKERS, queue_size=UPDATE_QUEUE_SIZE, backlog_dir=UPDATE_BACKLOG_DIR,
+    user_lock=AdvisoryUserLock(
+        f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}", pool_size=UPDATE_WORKERS
+    ) if BOT_REPLICAS > 1 else None,
+)
 
 def escape_markdown_v2(text: str) -> str:
     """
@@ -29,6 +108,79 @@ def escape_markdown_v2(text: str) -> str:
     pattern = r'([*_`$begin:math:display$$end:math:display$()~>#+\-=|{}.!])'
     return re.sub(pattern, r'\\\1', text)
 
+# Одна сессия к бэкенду на весь процесс бота: соединения переиспользуются (keep-alive)
+_backend_session: Optional[aiohttp.ClientSession] = None
+
+def backend_session() -> aiohttp.ClientSession:
+    global _backend_session
+    # Сессию создаём лениво: она должна принадлежать работающему циклу
+    if _backend_session is None or _backend_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=BACKEND_POOL_SIZE,
+            keepalive_timeout=BACKEND_KEEPALIVE,
+            ttl_dns_cache=300,
+        )
+        _backend_session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=BACKEND_TIMEOUT, connect=BACKEND_CONNECT_TIMEOUT),
+        )
+    return _backend_session
+
+async def close_backend_session():
+    global _backend_session
+    if _backend_session is not None and not _backend_session.closed:
+        await _backend_session.close()
+    _backend_session = None
+
+async def on_startup(dp):
+    backend_session()
+
+async def on_shutdown(dp):
+    await close_backend_session()
+
+# Webhook: апдейт сразу ставится в очередь пула, Telegram получает ответ без ожидания обработки
+class QueuedWebhookHandler(WebhookRequestHandler):
+    async def post(self):
+        if WEBHOOK_SECRET and self.request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+            return web.Response(status=403)
+        dispatcher = self.get_dispatcher()
+        update = await self.parse_update(dispatcher.bot)
+        if not await update_pool.submit(update):
+            # Бот останавливается: Telegram доставит апдейт повторно
+            return web.Response(status=503)
+        return web.Response(text='ok')
+
+async def on_startup_webhook(dp):
+    update_pool.start()
+    # Апдейты, не обработанные при прошлой остановке
+    await update_pool.restore()
+    webhook_url = f"{WEBHOOK_HOST}{WEBHOOK_PATH}"
+    # Несколько реплик стартуют одновременно: переустанавливаем webhook, только если он другой
+    info = await bot.get_webhook_info()
+    if info.url != webhook_url:
+        # Накопившиеся апдейты не сбрасываем: их обработает новая версия бота
+        await bot.set_webhook(webhook_url, secret_token=WEBHOOK_SECRET,
+                              max_connections=WEBHOOK_MAX_CONNECTIONS, drop_pending_updates=False)
+
+async def on_shutdown_webhook(dp):
+    # Webhook не удаляем: пока бот перезапускается, Telegram держит апдейты у себя.
+    # Новые апдейты пул уже не принимает (503), необработанные сохраняет в UPDATE_BACKLOG_DIR
+    await update_pool.stop()
+
+async def handle_bot_stats(request):
+    return web.json_response({'updates': update_pool.stats(), 'outbox': send_scheduler.stats()})
+
+def start_webhook():
+    if not WEBHOOK_HOST:
+        raise ValueError("Для режима webhook необходимо установить переменную окружения WEBHOOK_HOST")
+    app = web.Application()
+    app.router.add_get('/stats', handle_bot_stats)
+    runner = Executor(dp, skip_updates=False)
+    runner.on_startup([on_startup, on_startup_webhook], polling=False)
+    runner.on_shutdown([on_shutdown_webhook, on_shutdown], polling=False)
+    runner.set_webhook(webhook_path=WEBHOOK_PATH, request_handler=QueuedWebhookHandler, web_app=app)
+    runner.run_app(host=WEBAPP_HOST, port=WEBAPP_PORT)
+
 # Установка команд бота
 async def set_default_commands(dp):
     await bot.set_my_commands([
@@ -36,53 +188,45 @@ async def set_default_commands(dp):
         BotCommand("help", "Помощь")
     ])
 
-# Функция для проверки авторизации пользователя
-async def check_authorization(telegram_id):
-    async with aiohttp.ClientSession() as session:
-        async with session.get(f"{BACKEND_URL}/is_authorized", params={
-            'telegram_id': telegram_id
-        }) as resp:
-            if resp.status == 200:
-                data = await resp.json()
-                return data.get('authorized', False)
-            else:
-                return False
-
-# Функция для получения информации о пользователе
-async def get_user_info(telegram_id):
-    async with aiohttp.ClientSession() as session:
-        async with session.get(f"{BACKEND_URL}/user_info", params={
-            'telegram_id': telegram_id
-        }) as resp:
-            if resp.status == 200:
-                data = await resp.json()
-                return data
-            else:
-                return {}
-
-# Функция для генерации токена
-async def generate_token(telegram_id):
-    async with aiohttp.ClientSession() as session:
-        async with session.post(f"{BACKEND_URL}/generate_token", json={
-            'telegram_id': telegram_id
-        }) as resp:
-            if resp.status == 200:
-                data = await resp.json()
-                return data.get('token')
-            else:
-                return ''
+# Состояние пользователя для /start: авторизация, имя, токен и кабинеты — одним запросом
+async def bootstrap_user(telegram_id):
+    async with backend_session().get(f"{BACKEND_URL}/bootstrap", params={
+        'telegram_id': telegram_id
+    }) as resp:
+        if resp.status == 200:
+            return await resp.json()
+        else:
+            return {}
+
+# Кабинеты пользователя: telegram_id -> {'version': ..., 'accounts': [...]}.
+# Список меняется только при добавлении кабинета: тогда бэкенд увеличивает
+# accounts_version, а пользователь возвращается в бот через /start
+accounts_cache = TTLCache(maxsize=ACCOUNTS_CACHE_SIZE, ttl=ACCOUNTS_CACHE_TTL)
+
+def remember_accounts(telegram_id, accounts, version):
+    accounts_cache.set(telegram_id, {'version': version, 'accounts': accounts})
+
+# Сбрасываем кэш, если бэкенд сообщил другую версию списка кабинетов
+def check_accounts_version(telegram_id, version):
+    cached = accounts_cache.get(telegram_id)
+    if version is not None and cached is not None and cached['version'] != version:
+        accounts_cache.pop(telegram_id)
 
 # Функция для получения списка маркетплейсов и кабинетов пользователя
 async def get_user_marketplace_accounts(telegram_id):
-    async with aiohttp.ClientSession() as session:
-        async with session.get(f"{BACKEND_URL}/get_user_marketplace_accounts", params={
-            'telegram_id': telegram_id
-        }) as resp:
-            if resp.status == 200:
-                data = await resp.json()
-                return data.get('accounts', [])
-            else:
-                return []
+    cached = accounts_cache.get(telegram_id)
+    if cached is not None:
+        return cached['accounts']
+    async with backend_session().get(f"{BACKEND_URL}/get_user_marketplace_accounts", params={
+        'telegram_id': telegram_id
+    }) as resp:
+        if resp.status == 200:
+            data = await resp.json()
+            accounts = data.get('accounts', [])
+            remember_accounts(telegram_id, accounts, data.get('version'))
+            return accounts
+        else:
+            return []
 
 # Функция для отправки выбора маркетплейса
 async def send_marketplace_selection(chat_id):
@@ -187,15 +331,32 @@ async def send_main_menu(user_id: int, marketplace: str):
         reply_markup=keyboard
     )
 
-# Функция для удаления предыдущего сообщения бота
-async def delete_previous_bot_message(chat_id, user_id):
+# Функция для удаления предыдущего сообщения бота.
+# Удаление не блокирует ответ пользователю: выполняется в фоне
+async def delete_previous_bot_message(chat_id, user_id=None):
     user_data = await storage.get_data(chat=chat_id, user=user_id)
     last_message_id = user_data.get('last_bot_message_id')
     if last_message_id:
-        try:
-            await bot.delete_message(chat_id=chat_id, message_id=last_message_id)
-        except:
-            pass  # Если сообщение уже удалено или недоступно
+        fire_and_forget(delete_message_quietly(chat_id, last_message_id))
+
+async def delete_message_quietly(chat_id, message_id):
+    try:
+        await bot.delete_message(chat_id=chat_id, message_id=message_id)
+    except:
+        pass  # Если сообщение уже удалено или недоступно
+
+# Фоновые вызовы, результат которых обработчику не нужен; ссылки держим, чтобы задачи не собрал GC
+_background_tasks = set()
+
+def fire_and_forget(coro):
+    task = asyncio.ensure_future(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_task_done)
+
+def _background_task_done(task):
+    _background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        print(f"Background task failed: {task.exception()}")
 
 # Обработчик команды /start
 @dp.message_handler(commands=['start'])
@@ -208,17 +369,17 @@ async def cmd_start(message: types.Message):
     await storage.update_data(chat=chat_id, user=user_id, data=user_data)
 
     # Далее логика старта без state.finish()
-    is_authorized = await check_authorization(message.from_user.id)
+    state = await bootstrap_user(message.from_user.id)
+    auth_token = state.get('auth_token', '')
+    if state:
+        # /start (в том числе возврат из /add_marketplace) обновляет кэш кабинетов
+        remember_accounts(user_id, state.get('accounts', []), state.get('accounts_version'))
     await delete_previous_bot_message(chat_id, user_id)  # Удаляем предыдущее сообщение
-    if is_authorized:
+    if state.get('authorized'):
         # Удаляем клавиатуру
         await message.answer("Пожалуйста, выберите маркетплейс:", reply_markup=types.ReplyKeyboardRemove())
 
-        user_info = await get_user_info(message.from_user.id)
-        name = user_info.get('name', '')
-        auth_token = user_info.get('auth_token', '')
-        if not auth_token:
-            auth_token = await generate_token(message.from_user.id)
+        name = state.get('name', '')
         safe_name = escape_markdown_v2(name)
         greeting = f"Здравствуйте, {safe_name}! Добро пожаловать в *ReviewReplierBot*!\n\n"
         welcome_text = (
@@ -234,21 +395,20 @@ async def cmd_start(message: types.Message):
             InlineKeyboardButton("Помощь", callback_data="help")
         ]
         keyboard.add(*buttons)
-        # Отправляем изображение с сообщением
-        with open('welcome_image.jpg', 'rb') as photo:
-            sent_message = await message.answer_photo(
-                photo,
-                caption=welcome_text,
-                parse_mode=types.ParseMode.MARKDOWN,
-                reply_markup=keyboard
-            )
+        # Отправляем изображение с сообщением (по file_id, если оно уже загружено)
+        sent_message = await media_registry.send(
+            message.answer_photo,
+            'welcome_image.jpg',
+            caption=welcome_text,
+            parse_mode=types.ParseMode.MARKDOWN,
+            reply_markup=keyboard
+        )
         # Сохраняем message_id
         await storage.update_data(chat=chat_id, user=message.from_user.id, data={'last_bot_message_id': sent_message.message_id})
     else:
-        token = await generate_token(message.from_user.id)
         keyboard = InlineKeyboardMarkup(row_width=1)
         buttons = [
-            InlineKeyboardButton("Авторизоваться", url=f"{EXTERNAL_BACKEND_URL}/auth?token={token}"),
+            InlineKeyboardButton("Авторизоваться", url=f"{EXTERNAL_BACKEND_URL}/auth?token={auth_token}"),
             InlineKeyboardButton("Помощь", callback_data="help")
         ]
         keyboard.add(*buttons)
@@ -339,19 +499,16 @@ async def process_choose_marketplace(callback_query: types.CallbackQuery):
 async def handle_review_actions(message: types.Message):
     chat_id = message.chat.id
     user_id = message.from_user.id
-    user_data = await storage.get_data(chat=chat_id, user=user_id)
-
-    # Отправляем промежуточное сообщение
-    loading_message = await message.answer("🤖Получаем данные… \n✨Генерируем ответ… ")
 
     user_data = await storage.get_data(chat=chat_id, user=user_id)
     account_id = user_data.get('selected_account_id')
     if not account_id:
-        # Перед тем как ответить пользователю, удаляем промежуточное сообщение
-        await bot.delete_message(chat_id=chat_id, message_id=loading_message.message_id)
         await message.answer("Сначала выберите кабинет. Нажмите /start для выбора.")
         return
 
+    # Вместо промежуточного сообщения (отправка + удаление) — статус «печатает»
+    fire_and_forget(bot.send_chat_action(chat_id, types.ChatActions.TYPING))
+
     # Определяем, нужно ли использовать next_page_token
     page_token = None
     if "Перейти к следующему" in message.text:
@@ -365,58 +522,154 @@ async def handle_review_actions(message: types.Message):
     if page_token:
         params['page_token'] = page_token
 
-    async with aiohttp.ClientSession() as session:
-        async with session.get(f"{BACKEND_URL}/get_review", params=params) as resp:
-
-            # Удаляем промежуточное сообщение перед тем как отправить итоговый ответ
-            await bot.delete_message(chat_id=chat_id, message_id=loading_message.message_id)
-
-            if resp.status == 200:
-                data = await resp.json()
-                review = data.get('review')
-                reply = data.get('reply')
-                review_id = data.get('review_id')
-                new_next_page_token = data.get('next_page_token')
-                photos = data.get('photos', [])
+    # Отзыв приходит сразу, ответ — по частям (SSE). Отзыв с фото — одно сообщение,
+    # ответ с клавиатурой действий — второе, которое редактируем по мере генерации
+    stream_timeout = aiohttp.ClientTimeout(total=None, connect=BACKEND_CONNECT_TIMEOUT,
+                                           sock_read=BACKEND_STREAM_READ_TIMEOUT)
+    review_shown = False
+    reply_message = None
+    reply = ''
+    # Полный ответ из события done; пока его нет, частичный текст не предлагаем к отправке
+    final_reply = None
+    shown_reply = None
+    last_edit = 0.0
+    keyboard = review_actions_keyboard()
+    try:
+        async with backend_session().get(f"{BACKEND_URL}/get_review_stream", params=params,
+                                         timeout=stream_timeout) as resp:
+            if resp.status != 200:
+                await message.answer("Не удалось получить отзыв. Пожалуйста, попробуйте позже.")
+                return
+
+            async for event, data in iter_sse(resp):
+                if event == 'review':
+                    check_accounts_version(user_id, data.get('accounts_version'))
+                    review = data.get('review')
+                    review_id = data.get('review_id')
+                    if not review_id:
+                        await message.answer("Больше нет отзывов.")
+                        user_data['current_mode'] = None
+                        await storage.update_data(chat=chat_id, user=user_id, data=user_data)
+                        await send_main_menu(user_id, user_data.get('marketplace'))
+                        return
 
-                if review_id:
                     # Сохраняем данные
                     user_data['review'] = review
-                    user_data['suggested_reply'] = reply
+                    user_data['suggested_reply'] = None
                     user_data['review_id'] = review_id
-                    user_data['next_page_token'] = new_next_page_token
-                    user_data['current_mode'] = None
+                    user_data['next_page_token'] = data.get('next_page_token')
+                    user_data['current_mode'] = 'generating_reply'
                     await storage.update_data(chat=chat_id, user=user_id, data=user_data)
+                    review_shown = True
+
+                    await present_review(message, review, data.get('photos', []))
+
+                elif event == 'token' and review_shown:
+                    reply += data.get('text', '')
+                    if reply_message is None:
+                        reply_message = await message.answer(suggested_reply_text(reply + " …"),
+                                                             parse_mode=ParseMode.MARKDOWN_V2,
+                                                             reply_markup=keyboard)
+                        last_edit = time.monotonic()
+                        shown_reply = reply
+                    # Telegram ограничивает частоту правок, поэтому не чаще раза в REPLY_EDIT_INTERVAL
+                    elif time.monotonic() - last_edit >= REPLY_EDIT_INTERVAL:
+                        last_edit = time.monotonic()
+                        if await edit_suggested_reply(reply_message, reply + " …"):
+                            shown_reply = reply
+
+                elif event == 'done' and review_shown:
+                    if data.get('error'):
+                        # Ответ не сгенерирован: сообщение об этом — ниже, предлагать к отправке нечего
+                        break
+                    final_reply = data.get('reply', reply)
+                    if reply_message is None:
+                        # Готовый ответ (черновик, шаблон, кэш): отзыв и действия — за два сообщения
+                        reply_message = await message.answer(suggested_reply_text(final_reply),
+                                                             parse_mode=ParseMode.MARKDOWN_V2,
+                                                             reply_markup=keyboard)
+                    elif final_reply != shown_reply:
+                        await edit_suggested_reply(reply_message, final_reply)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        # Обрыв потока или таймаут чтения: ниже это обработается как ответ без события done
+        print(f"Error in review stream: {e}")
+    finally:
+        if review_shown:
+            # Режим генерации снимаем при любом исходе, иначе кнопка отправки так и будет ждать
+            user_data['current_mode'] = None
+            user_data['suggested_reply'] = final_reply
+            await storage.update_data(chat=chat_id, user=user_id, data=user_data)
 
-                    # Отправляем основной текст
-                    safe_review = escape_markdown_v2(review)
-                    await message.answer(f"**Отзыв:**\n\n{safe_review}", parse_mode=ParseMode.MARKDOWN_V2)
-
-                    # Отправляем фото (если есть)
-                    if photos:
-                        if len(photos) == 1:
-                            await message.answer_photo(photo=photos[0])
-                        else:
-                            media_group = MediaGroup()
-                            for p_url in photos:
-                                media_group.attach_photo(InputMediaPhoto(p_url))
-                            await message.answer_media_group(media_group)
-                    
-                    # Отправляем предложенный ответ
-                    safe_reply = escape_markdown_v2(reply)
-                    await message.answer(f"**Предлагаемый ответ:**\n\n{safe_reply}", parse_mode=ParseMode.MARKDOWN_V2)
-
-                    keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True)
-                    keyboard.add("Отправить предложенный ответ", "Написать свой ответ")
-                    keyboard.add("Перейти к следующему")
-                    await message.answer("Выберите действие:", reply_markup=keyboard)
-                else:
-                    await message.answer("Больше нет отзывов.")
-                    user_data['current_mode'] = None
-                    await storage.update_data(chat=chat_id, user=user_id, data=user_data)
-                    await send_main_menu(user_id, user_data.get('marketplace'))
+    if not review_shown:
+        # Поток оборвался до события review
+        await message.answer("Не удалось получить отзыв. Пожалуйста, попробуйте позже.")
+    elif final_reply is None:
+        await message.answer("Не удалось сгенерировать ответ. Напишите свой или перейдите к следующему отзыву.",
+                             reply_markup=keyboard)
+
+def review_actions_keyboard() -> types.ReplyKeyboardMarkup:
+    keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True)
+    keyboard.add("Отправить предложенный ответ", "Написать свой ответ")
+    keyboard.add("Перейти к следующему")
+    return keyboard
+
+# Ограничения Telegram: подпись к фото и число фото в альбоме
+CAPTION_LIMIT = 1024
+MEDIA_GROUP_LIMIT = 10
+
+# Отзыв и его фото одним сообщением: текст отзыва идёт подписью к фото (альбому)
+async def present_review(message: types.Message, review: str, photos: list):
+    text = f"**Отзыв:**\n\n{escape_markdown_v2(review)}"
+    photos = photos[:MEDIA_GROUP_LIMIT]
+    if not photos:
+        await message.answer(text, parse_mode=ParseMode.MARKDOWN_V2)
+        return
+
+    # Длинный отзыв в подпись не помещается: тогда текст и фото отдельно
+    caption = text if len(text) <= CAPTION_LIMIT else None
+    if caption is None:
+        await message.answer(text, parse_mode=ParseMode.MARKDOWN_V2)
+    if len(photos) == 1:
+        await message.answer_photo(photo=photos[0], caption=caption, parse_mode=ParseMode.MARKDOWN_V2)
+    else:
+        media_group = MediaGroup()
+        for index, p_url in enumerate(photos):
+            if index == 0 and caption:
+                media_group.attach_photo(InputMediaPhoto(p_url, caption=caption, parse_mode=ParseMode.MARKDOWN_V2))
             else:
-                await message.answer("Не удалось получить отзыв. Пожалуйста, попробуйте позже.")
+                media_group.attach_photo(InputMediaPhoto(p_url))
+        await message.answer_media_group(media_group)
+
+def suggested_reply_text(reply: str) -> str:
+    return f"**Предлагаемый ответ:**\n\n{escape_markdown_v2(reply)}"
+
+# Разбор потока Server-Sent Events от бэкенда: (event, data)
+async def iter_sse(resp):
+    event = 'message'
+    data_lines = []
+    async for raw_line in resp.content:
+        line = raw_line.decode('utf-8').rstrip('\r\n')
+        if not line:
+            if data_lines:
+                try:
+                    yield event, json.loads('\n'.join(data_lines))
+                except ValueError:
+                    pass
+            event = 'message'
+            data_lines = []
+        elif line.startswith('event:'):
+            event = line[len('event:'):].strip()
+        elif line.startswith('data:'):
+            data_lines.append(line[len('data:'):].lstrip())
+
+# Обновляем сообщение с предлагаемым ответом
+async def edit_suggested_reply(reply_message: types.Message, reply: str) -> bool:
+    try:
+        await reply_message.edit_text(suggested_reply_text(reply), parse_mode=ParseMode.MARKDOWN_V2)
+        return True
+    except (MessageNotModified, RetryAfter):
+        # Текст не изменился или упёрлись в лимит правок — покажем на следующей правке
+        return False
 
 # Обработка нажатий на новые кнопки 
 @dp.message_handler(lambda message: message.text in ["Отправить предложенный ответ", "Написать свой ответ"])
@@ -427,6 +680,9 @@ async def handle_reply_choice(message: types.Message):
 
     if message.text == "Отправить предложенный ответ":
         suggested_reply = user_data.get('suggested_reply')
+        if user_data.get('current_mode') == 'generating_reply':
+            await message.answer("Ответ ещё генерируется, подождите пару секунд.")
+            return
         if suggested_reply is None:
             await message.answer("Предложенный ответ не найден. Попробуйте снова получить отзыв.")
             return
@@ -459,14 +715,13 @@ async def send_user_reply(message: types.Message, custom_reply: str) -> bool:
         # Если не хватает данных, возвращаем False
         return False
 
-    async with aiohttp.ClientSession() as session:
-        async with session.post(f"{BACKEND_URL}/send_reply", json={
-            'telegram_id': user_id,
-            'account_id': account_id,
-            'review_id': review_id,
-            'reply': custom_reply
-        }) as resp:
-            return resp.status == 200
+    async with backend_session().post(f"{BACKEND_URL}/send_reply", json={
+        'telegram_id': user_id,
+        'account_id': account_id,
+        'review_id': review_id,
+        'reply': custom_reply
+    }, timeout=aiohttp.ClientTimeout(total=BACKEND_SEND_TIMEOUT)) as resp:
+        return resp.status == 200
 
 # Обработка подтверждения отправки пользовательского ответа (когда мы уже на этапе подтверждения)
 @dp.message_handler(lambda message: message.text in ["Да, отправить", "Нет, изменить"])
@@ -524,18 +779,20 @@ async def process_custom_reply(message: types.Message):
 
 # Функция для отправки ответа на Яндекс.Маркет
 async def send_reply_to_marketplace(telegram_id: int, account_id: int, review_id: int, reply: str) -> bool:
-    async with aiohttp.ClientSession() as session:
-        async with session.post(f"{BACKEND_URL}/send_reply", json={
-            'telegram_id': telegram_id,
-            'account_id': account_id,
-            'review_id': review_id,  # Передаём review_id
-            'reply': reply
-        }) as resp:
-            if resp.status == 200:
-                return True
-            else:
-                return False
+    async with backend_session().post(f"{BACKEND_URL}/send_reply", json={
+        'telegram_id': telegram_id,
+        'account_id': account_id,
+        'review_id': review_id,  # Передаём review_id
+        'reply': reply
+    }, timeout=aiohttp.ClientTimeout(total=BACKEND_SEND_TIMEOUT)) as resp:
+        if resp.status == 200:
+            return True
+        else:
+            return False
 
 if __name__ == '__main__':
-    executor.start_polling(dp, skip_updates=True)
+    if BOT_MODE == 'webhook':
+        start_webhook()
+    else:
+        executor.start_polling(dp, skip_updates=SKIP_UPDATES, on_startup=on_startup, on_shutdown=on_shutdown)
 
@@ -0,0 +1,249 @@
+# ReviewReplier
+# fsm_storage.py
+import asyncio
+import copy
+import json
+import typing
+from typing import Optional
+
+import asyncpg
+from aiogram.dispatcher.storage import BaseStorage
+
+from ttl_cache import TTLCache
+
+
+def combine_ops(old: dict, new: dict) -> dict:
+    """
+    Склеивает две отложенные записи одного ключа (old — более ранняя).
+    data_mode: None — данные не менялись, 'set' — замена, 'merge' — дополнение.
+    """
+    result = dict(old)
+    if new['state_set']:
+        result['state_set'] = True
+        result['state'] = new['state']
+    if new['data_mode'] == 'set' or new['data_mode'] == 'merge' and old['data_mode'] is None:
+        result['data_mode'] = new['data_mode']
+        result['data'] = new['data']
+    elif new['data_mode'] == 'merge':
+        result['data'] = {**old['data'], **new['data']}
+    return result
+
+
+def apply_op(entry: dict, op: Optional[dict]):
+    if op is None:
+        return
+    if op['state_set']:
+        entry['state'] = op['state']
+    if op['data_mode'] == 'set':
+        entry['data'] = copy.deepcopy(op['data'])
+    elif op['data_mode'] == 'merge':
+        entry['data'].update(copy.deepcopy(op['data']))
+
+
+class PostgresStorage(BaseStorage):
+    """
+    Хранилище состояний aiogram в таблице bot_fsm_states.
+
+    Запись отложенная: изменения копятся в памяти и раз в flush_interval
+    (или при batch_size ключей) уходят в БД одним пакетным UPSERT.
+    update_data пишется в БД как дополнение jsonb (data || patch), поэтому
+    несколько реплик бота не затирают ключи друг друга.
+    Чтение идёт из кэша на cache_ttl секунд; промах читает строку из БД и
+    накладывает на неё ещё не записанные изменения.
+
+    Кэш и отложенная запись безопасны, только пока все апдейты пользователя
+    обрабатывает один процесс. Если реплик несколько, нужен shared=True:
+    чтение всегда идёт в БД, а запись дожидается UPSERT, поэтому другая
+    реплика сразу видит последнее состояние.
+    """
+
+    UPSERT_SQL = """
+        INSERT INTO bot_fsm_states (chat_id, user_id, state, data, updated_at)
+        VALUES ($1, $2, $3, $4::jsonb, now())
+        ON CONFLICT (chat_id, user_id) DO UPDATE SET
+            state = CASE WHEN $5 THEN EXCLUDED.state ELSE bot_fsm_states.state END,
+            data = CASE $6::text
+                WHEN 'set' THEN EXCLUDED.data
+                WHEN 'merge' THEN bot_fsm_states.data || EXCLUDED.data
+                ELSE bot_fsm_states.data
+            END,
+            updated_at = now()
+    """
+
+    SELECT_SQL = "SELECT state, data FROM bot_fsm_states WHERE chat_id = $1 AND user_id = $2"
+
+    def __init__(self, dsn: str, pool_size: int = 10, flush_interval: float = 0.2,
+                 batch_size: int = 500, cache_ttl: float = 5.0, cache_size: int = 10000,
+                 shared: bool = False):
+        self.dsn = dsn
+        self.shared = shared
+        self.pool_size = pool_size
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        self._pending = {}
+        # Пакет, который сейчас записывается в БД
+        self._flushing = {}
+        self._pool: Optional[asyncpg.Pool] = None
+        # Примитивы asyncio создаём лениво: они должны принадлежать работающему циклу
+        self._pool_lock: Optional[asyncio.Lock] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._flush_task: Optional[asyncio.Task] = None
+        self._closing = False
+        self.counters = {'reads': 0, 'db_reads': 0, 'writes': 0, 'flushes': 0, 'flushed_rows': 0,
+                         'flush_errors': 0}
+
+    async def _get_pool(self) -> asyncpg.Pool:
+        if self._pool is None:
+            if self._pool_lock is None:
+                self._pool_lock = asyncio.Lock()
+            async with self._pool_lock:
+                if self._pool is None:
+                    self._pool = await asyncpg.create_pool(self.dsn, min_size=1, max_size=self.pool_size)
+        return self._pool
+
+    def _start_flusher(self):
+        if self._flush_task is None or self._flush_task.done():
+            self._wakeup = asyncio.Event()
+            self._flush_lock = asyncio.Lock()
+            self._flush_task = asyncio.ensure_future(self._flush_loop())
+
+    async def _flush_loop(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        """
+        Записывает в БД все накопленные изменения.
+        При ошибке они возвращаются в очередь и уйдут со следующей попыткой.
+        """
+        if not self._pending:
+            return
+        async with self._flush_lock:
+            batch, self._pending = self._pending, {}
+            self._flushing = batch
+            rows = [
+                (chat, user, op['state'], json.dumps(op['data'] or {}, ensure_ascii=False),
+                 op['state_set'], op['data_mode'])
+                for (chat, user), op in batch.items()
+            ]
+            try:
+                pool = await self._get_pool()
+                async with pool.acquire() as conn:
+                    await conn.executemany(self.UPSERT_SQL, rows)
+            except Exception as e:
+                # В том числе asyncpg.InterfaceError при разрыве соединения посреди executemany
+                self.counters['flush_errors'] += 1
+                print(f"FSM storage flush failed ({len(rows)} rows): {e}")
+                for key, op in batch.items():
+                    newer = self._pending.get(key)
+                    self._pending[key] = combine_ops(op, newer) if newer else op
+                return
+            finally:
+                self._flushing = {}
+            self.counters['flushes'] += 1
+            self.counters['flushed_rows'] += len(rows)
+
+    def _enqueue(self, key: tuple, op: dict):
+        self._start_flusher()
+        self.counters['writes'] += 1
+        pending = self._pending.get(key)
+        self._pending[key] = combine_ops(pending, op) if pending else op
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+
+    async def _load(self, key: tuple) -> dict:
+        self.counters['reads'] += 1
+        entry = None if self.shared else self._cache.get(key)
+        if entry is not None:
+            return entry
+
+        self.counters['db_reads'] += 1
+        # Не записанные в БД изменения накладываем до и после чтения:
+        # за время запроса часть из них может успеть записаться, а часть — появиться
+        before = (self._flushing.get(key), self._pending.get(key))
+        pool = await self._get_pool()
+        async with pool.acquire() as conn:
+            row = await conn.fetchrow(self.SELECT_SQL, *key)
+        entry = {'state': None, 'data': {}}
+        if row is not None:
+            entry = {'state': row['state'], 'data': json.loads(row['data']) if row['data'] else {}}
+        for op in before + (self._flushing.get(key), self._pending.get(key)):
+            apply_op(entry, op)
+        if not self.shared:
+            self._cache.set(key, entry)
+        return entry
+
+    async def _write(self, key: tuple, op: dict):
+        self._enqueue(key, op)
+        if self.shared:
+            # Другие реплики читают из БД: не возвращаемся, пока запись не дошла
+            await self.flush()
+
+    async def close(self):
+        # Не отменяем цикл посреди записи: даём ему завершиться и дописываем остаток
+        if self._flush_task is not None:
+            self._closing = True
+            self._wakeup.set()
+            await self._flush_task
+            self._flush_task = None
+            await self.flush()
+
+    async def wait_closed(self):
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+
+    async def get_state(self, *, chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        default: Optional[str] = None) -> Optional[str]:
+        key = self.check_address(chat=chat, user=user)
+        entry = await self._load(key)
+        return entry['state'] if entry['state'] is not None else self.resolve_state(default)
+
+    async def get_data(self, *, chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       default: Optional[dict] = None) -> typing.Dict:
+        key = self.check_address(chat=chat, user=user)
+        entry = await self._load(key)
+        # Копия: обработчики меняют полученный словарь перед update_data
+        return copy.deepcopy(entry['data'] or default or {})
+
+    async def set_state(self, *, chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        state: Optional[typing.AnyStr] = None):
+        key = self.check_address(chat=chat, user=user)
+        state = self.resolve_state(state)
+        entry = self._cache.get(key)
+        if entry is not None:
+            entry['state'] = state
+        await self._write(key, {'state': state, 'state_set': True, 'data': None, 'data_mode': None})
+
+    async def set_data(self, *, chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       data: typing.Dict = None):
+        key = self.check_address(chat=chat, user=user)
+        data = copy.deepcopy(data or {})
+        entry = self._cache.get(key)
+        if entry is not None:
+            entry['data'] = copy.deepcopy(data)
+        await self._write(key, {'state': None, 'state_set': False, 'data': data, 'data_mode': 'set'})
+
+    async def update_data(self, *, chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          data: typing.Dict = None, **kwargs):
+        key = self.check_address(chat=chat, user=user)
+        patch = copy.deepcopy({**(data or {}), **kwargs})
+        entry = self._cache.get(key)
+        if entry is not None:
+            entry['data'].update(copy.deepcopy(patch))
+        await self._write(key, {'state': None, 'state_set': False, 'data': patch, 'data_mode': 'merge'})
+
+    def stats(self) -> dict:
+        return {**self.counters, 'pending': len(self._pending), 'cache': self._cache.stats()}
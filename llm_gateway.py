@@ -0,0 +1,225 @@
+# ReviewReplier
+# llm_gateway.py
+import os
+import asyncio
+import random
+from typing import Optional
+
+import openai
+
+from rate_limit import TokenBucket
+
+LLM_MODEL = os.getenv('LLM_MODEL', 'gpt-4o-mini')
+LLM_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', '8'))
+LLM_REQUESTS_PER_MINUTE = float(os.getenv('LLM_REQUESTS_PER_MINUTE', '500'))
+LLM_TOKENS_PER_MINUTE = float(os.getenv('LLM_TOKENS_PER_MINUTE', '200000'))
+LLM_REQUEST_TIMEOUT = float(os.getenv('LLM_REQUEST_TIMEOUT', '30'))
+LLM_TOTAL_TIMEOUT = float(os.getenv('LLM_TOTAL_TIMEOUT', '90'))
+LLM_MAX_RETRIES = int(os.getenv('LLM_MAX_RETRIES', '4'))
+LLM_BACKOFF_BASE = float(os.getenv('LLM_BACKOFF_BASE', '1'))
+LLM_BACKOFF_MAX = float(os.getenv('LLM_BACKOFF_MAX', '20'))
+
+
+class LLMUnavailableError(Exception):
+    """
+    Не удалось получить ответ LLM: исчерпаны повторы или истёк общий таймаут.
+    """
+
+
+def estimate_tokens(messages: list, max_tokens: int) -> int:
+    # Грубая оценка: ~3 символа кириллицы на токен плюс максимум ответа
+    chars = sum(len(message.get('content') or '') for message in messages)
+    return chars // 3 + max_tokens
+
+
+class LLMGateway:
+    """
+    Асинхронный доступ к OpenAI с ограничениями:
+    не больше max_concurrency запросов одновременно, token bucket на запросы
+    и токены в минуту, повтор 429/5xx с экспоненциальной задержкой и
+    случайным разбросом, таймаут на попытку и на весь вызов (включая очередь).
+    """
+
+    def __init__(self, model: str = LLM_MODEL, max_concurrency: int = LLM_MAX_CONCURRENCY,
+                 requests_per_minute: float = LLM_REQUESTS_PER_MINUTE,
+                 tokens_per_minute: float = LLM_TOKENS_PER_MINUTE,
+                 request_timeout: float = LLM_REQUEST_TIMEOUT, total_timeout: float = LLM_TOTAL_TIMEOUT,
+                 max_retries: int = LLM_MAX_RETRIES):
+        self.model = model
+        self.max_concurrency = max_concurrency
+        self.request_timeout = request_timeout
+        self.total_timeout = total_timeout
+        self.max_retries = max_retries
+        self.requests = TokenBucket.per_minute(requests_per_minute)
+        self.tokens = TokenBucket.per_minute(tokens_per_minute)
+        self._client: Optional[openai.AsyncOpenAI] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self.counters = {'calls': 0, 'completed': 0, 'retries': 0, 'failed': 0, 'queued': 0, 'in_flight': 0}
+
+    def _get_client(self) -> openai.AsyncOpenAI:
+        if self._client is None:
+            # Повторы делаем сами, чтобы учитывать их в лимитах
+            self._client = openai.AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'), max_retries=0)
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.close()
+        self._client = None
+
+    async def complete(self, messages: list, max_tokens: int = 280, temperature: float = 0.8, **kwargs) -> str:
+        """
+        Возвращает текст ответа модели или выбрасывает LLMUnavailableError.
+        """
+        self.counters['calls'] += 1
+        try:
+            return await asyncio.wait_for(self._complete(messages, max_tokens, temperature, **kwargs),
+                                          self.total_timeout)
+        except asyncio.TimeoutError:
+            self.counters['failed'] += 1
+            raise LLMUnavailableError(f"LLM call exceeded {self.total_timeout}s")
+
+    async def _enter(self):
+        # Ждём свободный слот; очередь видна в stats()
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.counters['queued'] += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.counters['queued'] -= 1
+        self.counters['in_flight'] += 1
+
+    def _exit(self):
+        self.counters['in_flight'] -= 1
+        self._semaphore.release()
+
+    async def _complete(self, messages: list, max_tokens: int, temperature: float, **kwargs) -> str:
+        estimate = estimate_tokens(messages, max_tokens)
+        await self._enter()
+        try:
+            for attempt in range(self.max_retries + 1):
+                await self.requests.acquire()
+                await self.tokens.acquire(estimate)
+                try:
+                    response = await asyncio.wait_for(
+                        self._get_client().chat.completions.create(
+                            model=self.model,
+                            messages=messages,
+                            max_tokens=max_tokens,
+                            temperature=temperature,
+                            **kwargs
+                        ),
+                        self.request_timeout
+                    )
+                except (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError,
+                        asyncio.TimeoutError) as e:
+                    # APITimeoutError — подкласс APIConnectionError
+                    if attempt == self.max_retries:
+                        self.counters['failed'] += 1
+                        raise LLMUnavailableError(f"{type(e).__name__}: {e}") from e
+                    self.counters['retries'] += 1
+                    await asyncio.sleep(self._backoff(attempt, e))
+                    continue
+                except openai.OpenAIError as e:
+                    self.counters['failed'] += 1
+                    raise LLMUnavailableError(f"{type(e).__name__}: {e}") from e
+
+                # Корректируем лимит токенов по фактическому расходу
+                usage = getattr(response, 'usage', None)
+                if usage is not None and usage.total_tokens:
+                    self.tokens.adjust(estimate - usage.total_tokens)
+                self.counters['completed'] += 1
+                return response.choices[0].message.content.strip()
+        finally:
+            self._exit()
+
+    async def stream(self, messages: list, max_tokens: int = 280, temperature: float = 0.8, **kwargs):
+        """
+        Асинхронный генератор фрагментов ответа модели.
+        Повторяем только до первого фрагмента: начатый ответ уже показан пользователю.
+        Пауза между фрагментами ограничена request_timeout, весь вызов — total_timeout.
+        """
+        self.counters['calls'] += 1
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.total_timeout
+        estimate = estimate_tokens(messages, max_tokens)
+        started = False
+
+        def remaining() -> float:
+            left = deadline - loop.time()
+            if left <= 0:
+                raise asyncio.TimeoutError()
+            return left
+
+        try:
+            await asyncio.wait_for(self._enter(), remaining())
+        except asyncio.TimeoutError:
+            self.counters['failed'] += 1
+            raise LLMUnavailableError(f"LLM call exceeded {self.total_timeout}s")
+        try:
+            for attempt in range(self.max_retries + 1):
+                try:
+                    await asyncio.wait_for(self.requests.acquire(), remaining())
+                    await asyncio.wait_for(self.tokens.acquire(estimate), remaining())
+                    stream = await asyncio.wait_for(
+                        self._get_client().chat.completions.create(
+                            model=self.model,
+                            messages=messages,
+                            max_tokens=max_tokens,
+                            temperature=temperature,
+                            stream=True,
+                            **kwargs
+                        ),
+                        min(self.request_timeout, remaining())
+                    )
+                    iterator = stream.__aiter__()
+                    while True:
+                        try:
+                            chunk = await asyncio.wait_for(iterator.__anext__(),
+                                                           min(self.request_timeout, remaining()))
+                        except StopAsyncIteration:
+                            break
+                        delta = chunk.choices[0].delta.content if chunk.choices else None
+                        if delta:
+                            started = True
+                            yield delta
+                    self.counters['completed'] += 1
+                    return
+                except (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError,
+                        asyncio.TimeoutError) as e:
+                    if started or attempt == self.max_retries or loop.time() >= deadline:
+                        self.counters['failed'] += 1
+                        raise LLMUnavailableError(f"{type(e).__name__}: {e}") from e
+                    self.counters['retries'] += 1
+                    await asyncio.sleep(min(self._backoff(attempt, e), max(deadline - loop.time(), 0)))
+                except openai.OpenAIError as e:
+                    self.counters['failed'] += 1
+                    raise LLMUnavailableError(f"{type(e).__name__}: {e}") from e
+        finally:
+            self._exit()
+
+    @staticmethod
+    def _backoff(attempt: int, error: Exception) -> float:
+        # Retry-After от сервера важнее нашей оценки
+        response = getattr(error, 'response', None)
+        if response is not None:
+            retry_after = response.headers.get('retry-after')
+            try:
+                if retry_after:
+                    return min(float(retry_after), LLM_BACKOFF_MAX)
+            except ValueError:
+                pass
+        delay = min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** attempt)
+        return delay * random.uniform(0.5, 1.5)
+
+    def stats(self) -> dict:
+        return {
+            **self.counters,
+            'request_tokens_available': round(self.requests.tokens, 1),
+            'llm_tokens_available': round(self.tokens.tokens),
+        }
+
+
+# Общий шлюз к LLM для всего процесса бэкенда
+llm_gateway = LLMGateway()
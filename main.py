@@ -2,15 +2,27 @@
 # main.py
 import os
 import json
+import asyncio
 import uuid
-import requests
-import openai
 import datetime
+from typing import Optional
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request, Depends, HTTPException, Body
-from fastapi.responses import HTMLResponse
-from sqlalchemy import create_engine, Column, Integer, BigInteger, String, ForeignKey
-from sqlalchemy.orm import sessionmaker, declarative_base, relationship, Session
+from fastapi.responses import HTMLResponse, StreamingResponse
+from sqlalchemy import (create_engine, Column, Integer, BigInteger, Float, String, Text, Boolean, DateTime, JSON,
+                        ForeignKey, UniqueConstraint, Index, tuple_, case, select, update, delete, inspect, text)
+from sqlalchemy.dialects.postgresql import JSONB, insert as pg_insert
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy.orm import declarative_base, relationship, selectinload, joinedload, contains_eager
 from starlette.middleware.cors import CORSMiddleware
+from yandex_market import yandex_client
+from llm_gateway import llm_gateway
+from singleflight import RequestScope, upstream_flight
+from reply_cache import ReplyPoolCache, reply_cache_key, to_template, render_template
+from reply_templates import DEFAULT_TEMPLATES, is_trivial_review, pick_template
+from ttl_cache import TTLCache
+from rate_limit import PostgresRateLimiter
+from query_counter import track_queries, count_queries, uncounted
 
 app = FastAPI()
 
@@ -31,14 +43,31 @@ DB_HOST = os.getenv('DB_HOST', 'db')
 DB_PORT = os.getenv('DB_PORT', '5432')
 
 DATABASE_URL = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
-
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+ASYNC_DATABASE_URL = f"postgresql+asyncpg://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+
+# Пул на процесс uvicorn: DB_POOL_SIZE постоянных соединений и ещё до DB_MAX_OVERFLOW на пиках.
+# (DB_POOL_SIZE + DB_MAX_OVERFLOW) * число процессов должно оставаться меньше max_connections Postgres
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '10'))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '10'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '10'))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', '1800'))
+
+# Синхронный движок нужен только для создания таблиц при старте
+engine = create_engine(DATABASE_URL, pool_size=1, max_overflow=0)
+
+# Запросы эндпоинтов идут через asyncpg и не блокируют цикл событий
+async_engine = create_async_engine(
+    ASYNC_DATABASE_URL,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_recycle=DB_POOL_RECYCLE,
+    pool_pre_ping=True,
+)
+# expire_on_commit=False: после commit атрибуты читаются из памяти, без ленивых запросов
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
 Base = declarative_base()
 
-# Убедитесь, что ключ API передан
-openai.api_key = os.getenv('OPENAI_API_KEY')
-
 # Модели
 class Company(Base):
     __tablename__ = 'companies'
@@ -57,6 +86,8 @@ class User(Base):
     auth_token = Column(String, unique=True, index=True)
     company_id = Column(Integer, ForeignKey('companies.id'))
     company = relationship("Company", back_populates="users")
+    # Растёт при каждом изменении списка кабинетов; бот по нему сбрасывает свой кэш
+    accounts_version = Column(Integer, default=0, server_default='0', nullable=False)
     marketplace_accounts = relationship("MarketplaceAccount", back_populates="user")
 
 class Campaign(Base):
@@ -65,7 +96,7 @@ class Campaign(Base):
     id = Column(Integer, primary_key=True, index=True)
     
     # Связь с MarketplaceAccount (который хранит api_key, business_id и т.д.)
-    marketplace_account_id = Column(Integer, ForeignKey('marketplace_accounts.id'))
+    marketplace_account_id = Column(Integer, ForeignKey('marketplace_accounts.id'), index=True)
 
     # Собственно ID кампании на Я.Маркете
     campaign_id = Column(Integer, index=True)  
@@ -73,6 +104,9 @@ class Campaign(Base):
     name = Column(String)           # Например, "BlackSwan"
     placement_type = Column(String) # "FBY", "FBS" и т. п.
 
+    # Сколько раз заказы аккаунта находились в этой кампании (для порядка опроса)
+    order_hits = Column(Integer, default=0, server_default='0', nullable=False)
+
     # Допустим, если нужно хранить ещё какие-то поля из campaigns.
 
     # Связь обратно, если нужно
@@ -82,7 +116,7 @@ class MarketplaceAccount(Base):
     __tablename__ = 'marketplace_accounts'
 
     id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, ForeignKey('users.id'))
+    user_id = Column(Integer, ForeignKey('users.id'), index=True)
     marketplace = Column(String)
     account_name = Column(String)
     api_key = Column(String)
@@ -92,21 +126,213 @@ class MarketplaceAccount(Base):
 
     campaigns = relationship("Campaign", back_populates="account")
 
+# Локальная копия отзывов, загружаемая фоновым воркером
+class Review(Base):
+    __tablename__ = 'reviews'
+    __table_args__ = (
+        UniqueConstraint('business_id', 'feedback_id', name='uq_reviews_business_feedback'),
+        Index('ix_reviews_business_status_created', 'business_id', 'reaction_status', 'created_at', 'id'),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    business_id = Column(String, nullable=False)
+    feedback_id = Column(BigInteger, nullable=False)
+    author = Column(String)
+    advantages = Column(Text)
+    disadvantages = Column(Text)
+    comment = Column(Text)
+    rating = Column(Integer)
+    order_id = Column(BigInteger)
+    photos = Column(JSON)
+    created_at = Column(DateTime(timezone=True), nullable=False)
+    reaction_status = Column(String)  # "NEED_REACTION", "REACTED", "REPLIED"
+    synced_at = Column(DateTime(timezone=True))
+
+    # Заполняются при первом показе отзыва
+    offer_id = Column(String)
+    offer_name = Column(String)
+    placement_type = Column(String)
+    enriched = Column(Boolean, default=False, nullable=False)
+
+    # Заранее сгенерированный ответ
+    draft_reply = Column(Text)
+    draft_generated_at = Column(DateTime(timezone=True))
+
+# Кэш соответствия заказ -> товар (в том числе «в этой кампании заказа нет»)
+class OrderOfferCache(Base):
+    __tablename__ = 'order_offer_cache'
+    __table_args__ = (
+        UniqueConstraint('business_id', 'order_id', 'campaign_id', name='uq_order_offer_cache_key'),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    business_id = Column(String, nullable=False)
+    order_id = Column(BigInteger, nullable=False)
+    campaign_id = Column(BigInteger, nullable=False)
+    offer_id = Column(String)
+    offer_name = Column(String)
+    placement_type = Column(String)
+    found = Column(Boolean, nullable=False)
+    fetched_at = Column(DateTime(timezone=True), nullable=False)
+
+# Сохранённые ответы на одинаковые отзывы (ключ — хэш нормализованных полей промпта)
+class ReplyCacheEntry(Base):
+    __tablename__ = 'reply_cache'
+
+    id = Column(Integer, primary_key=True, index=True)
+    key_hash = Column(String(64), nullable=False, index=True)
+    reply = Column(Text, nullable=False)
+    created_at = Column(DateTime(timezone=True), nullable=False, index=True)
+
+# Шаблоны ответов компании на отзывы без текста ({author}, {product}, {seller})
+class ReplyTemplate(Base):
+    __tablename__ = 'reply_templates'
+
+    id = Column(Integer, primary_key=True, index=True)
+    company_id = Column(Integer, ForeignKey('companies.id'), index=True)
+    min_rating = Column(Integer, default=4)
+    max_rating = Column(Integer, default=5)
+    product_name = Column(String)  # None — для любого товара
+    text = Column(Text, nullable=False)
+
+# Состояние token bucket для квот внешних API, общее для всех процессов
+class ApiRateLimit(Base):
+    __tablename__ = 'api_rate_limits'
+
+    key = Column(String, primary_key=True)  # "yandex:<метод>:<business_id/campaign_id>"
+    tokens = Column(Float, nullable=False)
+    updated_at = Column(DateTime(timezone=True), nullable=False)
+
+# Бизнесы, отзывы которых хотя бы раз загружены в reviews (в том числе пустым списком)
+class ReviewSync(Base):
+    __tablename__ = 'review_syncs'
+
+    business_id = Column(String, primary_key=True)
+    synced_at = Column(DateTime(timezone=True), nullable=False)
+
+# Состояния диалогов бота (aiogram FSM); пишет и читает только бот
+class BotFSMState(Base):
+    __tablename__ = 'bot_fsm_states'
+
+    chat_id = Column(BigInteger, primary_key=True)
+    user_id = Column(BigInteger, primary_key=True)
+    state = Column(String)
+    data = Column(JSONB, nullable=False, server_default='{}')
+    updated_at = Column(DateTime(timezone=True), nullable=False)
+
 # Создание таблиц
 Base.metadata.create_all(bind=engine)
+engine.dispose()
+
+# Квоты Яндекс.Маркета считаем в Postgres: иначе каждый воркер uvicorn тратил бы их независимо
+yandex_client.limiter = PostgresRateLimiter(AsyncSessionLocal)
+
+# Закрываем пулы соединений к Яндекс.Маркету и OpenAI при остановке
+@app.on_event("shutdown")
+async def close_yandex_client():
+    await yandex_client.close()
+    await llm_gateway.close()
+
+# Запускаем фоновую загрузку отзывов
+@app.on_event("startup")
+async def start_review_ingestion():
+    app.state.review_ingestion = asyncio.create_task(review_ingestion_loop())
+
+@app.on_event("shutdown")
+async def stop_review_ingestion():
+    task = getattr(app.state, 'review_ingestion', None)
+    if task:
+        task.cancel()
+
+# Пул БД закрываем последним, после остановки фоновой загрузки
+@app.on_event("shutdown")
+async def close_database():
+    await async_engine.dispose()
 
 # Dependency для получения сессии базы данных
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
+
+# Сколько SQL-запросов эндпоинт может выполнить в худшем случае (служебные запросы
+# лимитера квот не считаются). Превышения видны в /stats, а с QUERY_BUDGET_STRICT=1
+# запрос завершается ошибкой со списком запросов — для проверки на стенде
+QUERY_BUDGETS = {
+    '/is_authorized': 1,
+    '/user_info': 1,
+    '/get_user_marketplace_accounts': 2,
+    '/bootstrap': 3,
+    '/generate_token': 2,
+    '/get_review': 11,
+    '/send_reply': 2,
+}
+QUERY_BUDGET_STRICT = os.getenv('QUERY_BUDGET_STRICT', '0') == '1'
+
+query_stats = {}
+track_queries(async_engine)
+
+@app.middleware("http")
+async def check_query_budget(request: Request, call_next):
+    path = request.url.path
+    budget = QUERY_BUDGETS.get(path)
+    if budget is None:
+        return await call_next(request)
+
+    with count_queries() as counter:
+        response = await call_next(request)
+    stats = query_stats.setdefault(path, {'requests': 0, 'queries': 0, 'max': 0, 'over_budget': 0})
+    stats['requests'] += 1
+    stats['queries'] += counter.count
+    stats['max'] = max(stats['max'], counter.count)
+    if counter.count > budget:
+        stats['over_budget'] += 1
+        print(f"Query budget exceeded for {path}: {counter.count} > {budget}")
+        if QUERY_BUDGET_STRICT:
+            counter.check(budget, path)
+    return response
+
+# Кэш личности пользователя по telegram_id: id, компания, имя и признак авторизации.
+# Сбрасывается там, где эти данные меняются (generate_token, /auth, /add_marketplace), /bootstrap
+# кладёт свежую запись; в других процессах uvicorn запись устаревает не дольше IDENTITY_CACHE_TTL
+IDENTITY_CACHE_TTL = int(os.getenv('IDENTITY_CACHE_TTL', '300'))
+IDENTITY_CACHE_SIZE = int(os.getenv('IDENTITY_CACHE_SIZE', '10000'))
+
+identity_cache = TTLCache(maxsize=IDENTITY_CACHE_SIZE, ttl=IDENTITY_CACHE_TTL)
+identity_stats = {'invalidations': 0}
+
+def remember_identity(user: 'User') -> dict:
+    identity = {
+        'id': user.id,
+        'company_id': user.company_id,
+        'name': user.name,
+        'auth_token': user.auth_token,
+        'accounts_version': user.accounts_version,
+        'authorized': bool(user.name and user.company_id),
+    }
+    identity_cache.set(user.telegram_id, identity)
+    return identity
+
+def invalidate_identity(telegram_id: int):
+    identity_cache.pop(telegram_id)
+    identity_stats['invalidations'] += 1
+
+async def get_identity(telegram_id: int, db: AsyncSession):
+    """
+    Личность пользователя из кэша или из БД; None, если пользователя нет
+    (отсутствие не кэшируется: пользователь может появиться в другом процессе).
+    """
+    identity = identity_cache.get(telegram_id)
+    if identity is None:
+        user = await db.scalar(select(User).where(User.telegram_id == telegram_id))
+        if user is None:
+            return None
+        identity = remember_identity(user)
+    return identity
 
 # Эндпоинт для авторизации (GET)
 @app.get('/auth', response_class=HTMLResponse)
-async def auth_form(token: str, action: str = None, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.auth_token == token).first()
+async def auth_form(token: str, action: str = None, db: AsyncSession = Depends(get_db)):
+    user = await db.scalar(select(User).where(User.auth_token == token))
     if not user:
         raise HTTPException(status_code=404, detail='Invalid token')
 
@@ -158,11 +384,11 @@ async def auth_form(token: str, action: str = None, db: Session = Depends(get_db
 
 # Эндпоинт для первичной авторизации (POST)
 @app.post('/auth', response_class=HTMLResponse)
-async def auth_submit(request: Request, db: Session = Depends(get_db)):
+async def auth_submit(request: Request, db: AsyncSession = Depends(get_db)):
     form_data = await request.form()
     token = form_data.get('token')
     action = form_data.get('action')
-    user = db.query(User).filter(User.auth_token == token).first()
+    user = await db.scalar(select(User).where(User.auth_token == token))
     if not user:
         raise HTTPException(status_code=404, detail='Invalid token')
 
@@ -177,14 +403,14 @@ async def auth_submit(request: Request, db: Session = Depends(get_db)):
 
         company_code = form_data.get('company_code')
         if company_code:
-            company = db.query(Company).filter(Company.code == company_code).first()
+            company = await db.scalar(select(Company).where(Company.code == company_code))
             if not company:
                 return HTMLResponse(content="<h2>Неверный код компании. Пожалуйста, попробуйте снова.</h2>")
             user.company_id = company.id
         else:
             return HTMLResponse(content="<h2>Код компании обязателен для заполнения.</h2>")
     else:
-        company = user.company
+        company = await db.get(Company, user.company_id) if user.company_id else None
 
     # Обработка маркетплейсов и API-ключей
     supported_marketplaces = ["Яндекс.Маркет", "OZON", "Wildberries"]
@@ -193,28 +419,19 @@ async def auth_submit(request: Request, db: Session = Depends(get_db)):
         if api_key:
 
             if marketplace == 'Яндекс.Маркет':
-                # запрос /campaigns
-                headers = {
-                    'Authorization': f'Bearer {api_key}',
-                    'Content-Type': 'application/json'
-                }
-                params = {
-                    'page': 1,
-                    'pageSize': 50  # Получим побольше кампаний
-                }
-                response = requests.get('https://api.partner.market.yandex.ru/campaigns', headers=headers, params=params)
-                if response.status_code == 200:
-                    data = response.json()
-                    campaigns = data.get('campaigns', [])
+                # запрос /campaigns (получим побольше кампаний)
+                result = await yandex_client.get_campaigns(api_key, page_size=50)
+                if result.response.ok:
+                    campaigns = result.campaigns
                     if not campaigns:
                         return HTMLResponse(content="<h2>Не найдено ни одной кампании для данного API-ключа.</h2>")
                     else:
                         # Берём business_id и business_name из первой кампании
                         camp0 = campaigns[0]
-                        business_id = camp0['business']['id']
-                        business_name = camp0['business']['name']
+                        business_id = camp0.business_id
+                        business_name = camp0.business_name
                 else:
-                    return HTMLResponse(content=f"<h2>Ошибка: {response.status_code}</h2><pre>{response.text}</pre>")
+                    return HTMLResponse(content=f"<h2>Ошибка: {result.response.status}</h2><pre>{result.response.text}</pre>")
 
             # Создаём MarketplaceAccount
             new_account = MarketplaceAccount(
@@ -226,22 +443,25 @@ async def auth_submit(request: Request, db: Session = Depends(get_db)):
                 business_name=business_name
             )
             db.add(new_account)
-            db.commit()
-            db.refresh(new_account)  # чтобы получить new_account.id
+            # Бот сверяет версию со своим кэшем кабинетов: без неё новый кабинет не увидит
+            user.accounts_version = User.accounts_version + 1
+            await db.commit()
+            await db.refresh(new_account)  # чтобы получить new_account.id
 
             # Теперь сохраняем все кампании
             if marketplace == 'Яндекс.Маркет':
                 for camp in campaigns:
                     new_camp = Campaign(
                         marketplace_account_id=new_account.id,
-                        campaign_id=camp['id'],
-                        domain=camp.get('domain'),
-                        name=camp.get('name'),
-                        placement_type=camp.get('placementType')
+                        campaign_id=camp.id,
+                        domain=camp.domain,
+                        name=camp.name,
+                        placement_type=camp.placement_type
                     )
                     db.add(new_camp)
 
-    db.commit()
+    await db.commit()
+    invalidate_identity(user.telegram_id)
 
     # Возвращаем сообщение об успешном сохранении
     bot_username = os.getenv('BOT_USERNAME', 'your_bot_username')
@@ -262,8 +482,8 @@ async def auth_submit(request: Request, db: Session = Depends(get_db)):
 
 # эндпоинт для добавления кабинетов (GET)
 @app.get('/add_marketplace', response_class=HTMLResponse)
-async def add_marketplace_form(token: str, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.auth_token == token).first()
+async def add_marketplace_form(token: str, db: AsyncSession = Depends(get_db)):
+    user = await db.scalar(select(User).where(User.auth_token == token))
     if not user:
         raise HTTPException(status_code=404, detail='Invalid token')
 
@@ -295,10 +515,10 @@ async def add_marketplace_form(token: str, db: Session = Depends(get_db)):
 
 # Обработчик формы (POST)
 @app.post('/add_marketplace', response_class=HTMLResponse)
-async def add_marketplace_submit(request: Request, db: Session = Depends(get_db)):
+async def add_marketplace_submit(request: Request, db: AsyncSession = Depends(get_db)):
     form_data = await request.form()
     token = form_data.get('token')
-    user = db.query(User).filter(User.auth_token == token).first()
+    user = await db.scalar(select(User).where(User.auth_token == token))
     if not user:
         raise HTTPException(status_code=404, detail='Invalid token')
 
@@ -307,28 +527,19 @@ async def add_marketplace_submit(request: Request, db: Session = Depends(get_db)
 
     if marketplace == 'Яндекс.Маркет':
         # Запрашиваем информацию о бизнесе
-        headers = {
-            'Authorization': f'Bearer {api_key}',
-            'Content-Type': 'application/json'
-        }
-        params = {
-            'page': 1,
-            'pageSize': 1  # Вы можете установить нужный размер страницы
-        }
-        response = requests.get('https://api.partner.market.yandex.ru/campaigns', headers=headers, params=params)
-        if response.status_code == 200:
-            data = response.json()
-            campaigns = data.get('campaigns', [])
+        result = await yandex_client.get_campaigns(api_key, page_size=1)
+        if result.response.ok:
+            campaigns = result.campaigns
             if not campaigns:
                 # Если список кампаний пуст
                 return HTMLResponse(content="<h2>Не найдено ни одной кампании для данного API-ключа.</h2>")
             else:
                 # Обрабатываем полученные кампании
                 campaign = campaigns[0]
-                business_id = campaign['business']['id']
-                business_name = campaign['business']['name']
+                business_id = campaign.business_id
+                business_name = campaign.business_name
         else:
-            return HTMLResponse(content=f"<h2>Ошибка при получении информации о бизнесе: {response.status_code}</h2><pre>{response.text}</pre>")
+            return HTMLResponse(content=f"<h2>Ошибка при получении информации о бизнесе: {result.response.status}</h2><pre>{result.response.text}</pre>")
     else:
         # Для других маркетплейсов
         business_id = None
@@ -344,7 +555,9 @@ async def add_marketplace_submit(request: Request, db: Session = Depends(get_db)
         business_name=business_name
     )
     db.add(new_account)
-    db.commit()
+    user.accounts_version = User.accounts_version + 1
+    await db.commit()
+    invalidate_identity(user.telegram_id)
 
     # Возвращаем сообщение об успешном добавлении
     bot_username = os.getenv('BOT_USERNAME', 'your_bot_username')
@@ -352,7 +565,7 @@ async def add_marketplace_submit(request: Request, db: Session = Depends(get_db)
     <h2>Кабинет '{business_name}' успешно добавлен.</h2>
     <p>Маркетплейс: {marketplace}</p>
     <p>Вы можете вернуться в бот, чтобы продолжить работу.</p>
-    <a href="tg://resolve?domain={bot_username}">Перейти в бот</a>
+    <a href="tg://resolve?domain={bot_username}&start=accounts_updated">Перейти в бот</a>
     """)
 
 # Эндпоинт для генерации токена и сохранения пользователя
@@ -362,88 +575,180 @@ class TokenRequest(BaseModel):
     telegram_id: int
 
 @app.post('/generate_token')
-async def generate_token(request: TokenRequest, db: Session = Depends(get_db)):
+async def generate_token(request: TokenRequest, db: AsyncSession = Depends(get_db)):
     telegram_id = request.telegram_id
     token = str(uuid.uuid4())
-    user = db.query(User).filter(User.telegram_id == telegram_id).first()
+    user = await db.scalar(select(User).where(User.telegram_id == telegram_id))
     if user:
         user.auth_token = token
     else:
         user = User(telegram_id=telegram_id, auth_token=token)
         db.add(user)
-    db.commit()
+    await db.commit()
+    invalidate_identity(telegram_id)
     return {'token': token}
 
 # Эндпоинт для проверки авторизации пользователя
 @app.get('/is_authorized')
-async def is_authorized(telegram_id: int, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.telegram_id == telegram_id).first()
-    if user:
-        # Проверяем, что у пользователя есть имя и компания
-        if not user.name or not user.company_id:
-            return {'authorized': False}
-        # Проверяем, есть ли у пользователя хотя бы один кабинет маркетплейса
-        accounts = db.query(MarketplaceAccount).filter(MarketplaceAccount.user_id == user.id).all()
-        if accounts:
-            return {'authorized': True}
-        else:
-            # Если нет кабинетов, но есть имя и компания, считаем пользователя авторизованным
-            return {'authorized': True}
-    return {'authorized': False}
+async def is_authorized(telegram_id: int, db: AsyncSession = Depends(get_db)):
+    # Авторизован тот, у кого есть имя и компания; кабинеты маркетплейсов не обязательны
+    identity = await get_identity(telegram_id, db)
+    return {'authorized': bool(identity and identity['authorized'])}
 
 # Эндпоинт для получения информации о пользователе
 @app.get('/user_info')
-async def user_info(telegram_id: int, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.telegram_id == telegram_id).first()
-    if user:
+async def user_info(telegram_id: int, db: AsyncSession = Depends(get_db)):
+    identity = await get_identity(telegram_id, db)
+    if identity:
         return {
-            'name': user.name,
-            'auth_token': user.auth_token
+            'name': identity['name'],
+            'auth_token': identity['auth_token']
         }
     else:
         raise HTTPException(status_code=404, detail='User not found')
 
 # Эндпоинт для получения кабинетов пользователя
 @app.get('/get_user_marketplace_accounts')
-async def get_user_marketplace_accounts(telegram_id: int, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.telegram_id == telegram_id).first()
-    if user:
-        accounts = db.query(MarketplaceAccount).filter(MarketplaceAccount.user_id == user.id).all()
+async def get_user_marketplace_accounts(telegram_id: int, db: AsyncSession = Depends(get_db)):
+    identity = await get_identity(telegram_id, db)
+    if identity:
+        accounts = (await db.scalars(
+            select(MarketplaceAccount).where(MarketplaceAccount.user_id == identity['id'])
+        )).all()
         return {'accounts': [
             {
                 'id': account.id,
                 'marketplace': account.marketplace,
                 'account_name': account.account_name
             } for account in accounts
-        ]}
+        ], 'version': identity['accounts_version']}
     else:
-        return {'accounts': []}
+        return {'accounts': [], 'version': 0}
+
+# Всё, что нужно боту для /start, за один запрос к БД:
+# пользователь и его кабинеты одним LEFT JOIN, токен создаётся при отсутствии
+@app.get('/bootstrap')
+async def bootstrap(telegram_id: int, db: AsyncSession = Depends(get_db)):
+    rows = (await db.execute(
+        select(User, MarketplaceAccount).outerjoin(
+            MarketplaceAccount, MarketplaceAccount.user_id == User.id
+        ).where(User.telegram_id == telegram_id).order_by(MarketplaceAccount.id)
+    )).all()
+
+    user = rows[0][0] if rows else None
+    if user is None:
+        user = User(telegram_id=telegram_id, auth_token=str(uuid.uuid4()))
+        db.add(user)
+        await db.commit()
+        # Новую строку перечитываем целиком: ленивой догрузки полей в асинхронной сессии нет
+        await db.refresh(user)
+    elif not user.auth_token:
+        user.auth_token = str(uuid.uuid4())
+        await db.commit()
+    # Пользователь только что прочитан из БД — обновляем кэш
+    identity = remember_identity(user)
+
+    return {
+        'authorized': identity['authorized'],
+        'name': user.name or '',
+        'auth_token': user.auth_token,
+        'accounts_version': user.accounts_version,
+        'accounts': [
+            {
+                'id': account.id,
+                'marketplace': account.marketplace,
+                'account_name': account.account_name
+            } for _, account in rows if account is not None
+        ],
+    }
 
-# Эндпоинт для получения свежего отзыва
-@app.get('/get_review')
-async def get_review(telegram_id: int, account_id: int, page_token: str = None, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.telegram_id == telegram_id).first()
-    if not user:
+# Проверки доступа для эндпоинтов, работающих с кабинетом пользователя
+async def get_authorized_user(telegram_id: int, db: AsyncSession) -> dict:
+    identity = await get_identity(telegram_id, db)
+    if not identity:
         raise HTTPException(status_code=400, detail='User not authorized')
+    return identity
 
-    account = db.query(MarketplaceAccount).filter(
+async def get_user_account(user_id: int, account_id: int, db: AsyncSession) -> MarketplaceAccount:
+    account = await db.scalar(select(MarketplaceAccount).where(
         MarketplaceAccount.id == account_id,
-        MarketplaceAccount.user_id == user.id
-    ).first()
+        MarketplaceAccount.user_id == user_id
+    ))
     if not account:
         raise HTTPException(status_code=400, detail='Marketplace account not found')
+    return account
+
+# Кабинет вместе с пользователем (account.user) и кампаниями (account.campaigns) одним запросом
+async def load_user_account(telegram_id: int, account_id: int, db: AsyncSession) -> MarketplaceAccount:
+    account = (await db.scalars(
+        select(MarketplaceAccount)
+        .join(MarketplaceAccount.user)
+        .options(contains_eager(MarketplaceAccount.user), joinedload(MarketplaceAccount.campaigns))
+        .where(User.telegram_id == telegram_id, MarketplaceAccount.id == account_id)
+    )).unique().one_or_none()
+    if account is None:
+        # Ошибки те же, что у get_authorized_user/get_user_account; лишний запрос — только здесь
+        await get_authorized_user(telegram_id, db)
+        raise HTTPException(status_code=400, detail='Marketplace account not found')
+    return account
+
+# Dependency для эндпоинтов с telegram_id и account_id в параметрах запроса
+async def user_account(telegram_id: int, account_id: int,
+                       db: AsyncSession = Depends(get_db)) -> MarketplaceAccount:
+    return await load_user_account(telegram_id, account_id, db)
+
+# Ссылки на фоновые задачи: иначе незавершённую задачу может собрать сборщик мусора
+_background_tasks = set()
+
+def spawn(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+# Общая часть /get_review и /get_review_stream: отзыв кабинета
+async def load_review(account: MarketplaceAccount, page_token: str, db: AsyncSession):
+    # Одинаковые вызовы Яндекс.Маркета внутри запроса выполняются один раз
+    upstream = RequestScope(upstream_flight)
 
     if account.marketplace == 'Яндекс.Маркет':
-        review, review_id, next_page_token, short_data = get_last_review_yandex(account, page_token, db)
+        result = await get_review_from_db(account, page_token, db, upstream)
+        if result is None:
+            # Отзывы этого бизнеса ещё не загружены: отдаём вживую и запускаем загрузку
+            spawn(ingest_business_reviews_by_id(account.id))
+            result = await get_last_review_yandex(account, page_token, db, upstream)
     else:
         raise HTTPException(status_code=400, detail='Marketplace not supported yet')
 
+    return result
+
+# Ответ, который можно отдать без обращения к LLM
+async def ready_reply(short_data: dict, user: User, db: AsyncSession):
+    # Готовый черновик, если фоновая генерация уже успела его сделать
+    reply = short_data.get('draft_reply')
+    if reply:
+        return reply
+    # Пустой отзыв с высокой оценкой отвечаем по шаблону компании,
+    # а ответ на такой же отзыв мог уже быть сгенерирован
+    return await template_reply(short_data, user.company_id, db) or await lookup_cached_reply(short_data, db)
+
+# Эндпоинт для получения свежего отзыва
+@app.get('/get_review')
+async def get_review(page_token: str = None, account: MarketplaceAccount = Depends(user_account),
+                     db: AsyncSession = Depends(get_db)):
+    user = account.user
+    review, review_id, next_page_token, short_data = await load_review(account, page_token, db)
+
     # Генерируем ответ
-    review, review_id, next_page_token, short_data = get_last_review_yandex(account, page_token, db)
     if review_id:
-        # Вызываем новую версию generate_reply_to_review, 
-        # куда передадим short_data
-        reply = generate_reply_to_review(short_data)
+        reply = await ready_reply(short_data, user, db)
+        if not reply:
+            # Вызываем новую версию generate_reply_to_review, 
+            # куда передадим short_data
+            reply = await generate_reply_to_review(short_data)
+            await store_cached_reply(short_data, reply, db)
+        if reply != REPLY_GENERATION_FAILED and not short_data.get('draft_reply'):
+            await save_review_draft(db, account.business_id, review_id, reply)
     else:
         reply = ""
 
@@ -456,71 +761,329 @@ async def get_review(telegram_id: int, account_id: int, page_token: str = None,
         'reply': reply,
         'review_id': review_id,
         'next_page_token': next_page_token,
-        'photos': photos
+        'photos': photos,
+        'accounts_version': user.accounts_version
     }
 
     return response_data
 
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+# Потоковый вариант /get_review (Server-Sent Events):
+# сначала событие review, затем token по мере генерации и done с полным ответом
+@app.get('/get_review_stream')
+async def get_review_stream(page_token: str = None, account: MarketplaceAccount = Depends(user_account),
+                            db: AsyncSession = Depends(get_db)):
+    user = account.user
+    review, review_id, next_page_token, short_data = await load_review(account, page_token, db)
+    reply = await ready_reply(short_data, user, db) if review_id else ""
+    has_draft = bool(short_data.get('draft_reply'))
+    business_id = account.business_id
+    accounts_version = user.accounts_version
+
+    async def events():
+        yield sse_event('review', {
+            'review': review,
+            'review_id': review_id,
+            'next_page_token': next_page_token,
+            'photos': short_data.get("photos", []),
+            'accounts_version': accounts_version
+        })
+        if not review_id or reply:
+            yield sse_event('done', {'reply': reply})
+            return
+
+        parts = []
+        try:
+            async for delta in llm_gateway.stream(build_reply_messages(short_data), max_tokens=280, temperature=0.8):
+                parts.append(delta)
+                yield sse_event('token', {'text': delta})
+            generated = ''.join(parts).strip()
+        except Exception as e:
+            print(f"Error in get_review_stream: {e}")
+            generated = ''
+
+        if not generated:
+            # Текст ошибки не выдаём за ответ: бот предложил бы отправить его покупателю
+            yield sse_event('done', {'reply': None, 'error': REPLY_GENERATION_FAILED})
+            return
+
+        if not has_draft:
+            # Ответ уже сгенерирован: ошибка сохранения не должна лишить клиента события done
+            try:
+                # Сессия запроса к этому моменту может быть уже закрыта
+                async with AsyncSessionLocal() as stream_db:
+                    await store_cached_reply(short_data, generated, stream_db)
+                    await save_review_draft(stream_db, business_id, review_id, generated)
+            except Exception as e:
+                print(f"Error saving streamed reply: {e}")
+        yield sse_event('done', {'reply': generated})
+
+    return StreamingResponse(events(), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# Эндпоинт со статистикой внутренних кэшей и дедупликации
+@app.get('/stats')
+async def stats():
+    return {
+        'upstream': upstream_flight.stats(),
+        'yandex': yandex_client.stats(),
+        'llm': llm_gateway.stats(),
+        'order_cache': dict(order_cache_stats),
+        'order_routing': order_routing_stats(),
+        'queries': {path: {**stats, 'budget': QUERY_BUDGETS[path]} for path, stats in query_stats.items()},
+        'reply_cache': {**reply_cache_stats, 'memory': reply_pool_cache.stats()},
+        'identity_cache': {**identity_cache.stats(), **identity_stats},
+        'reply_templates': {
+            **template_stats,
+            'fast_path_ratio': round(template_stats['fast_path'] / template_stats['checked'], 3)
+            if template_stats['checked'] else None,
+        },
+    }
+
 # Функция для форматирования даты
 def format_yandex_date(date_str: str) -> str:
     """
     Принимает дату в формате "2025-01-27T11:35:23.1+03:00"
     и возвращает "27.01.2025 11:35 Мск"
     """
-    
+    return parse_yandex_date(date_str).strftime("%d.%m.%Y %H:%M") + " Мск"
+
+def parse_yandex_date(date_str: str) -> datetime.datetime:
     try:
         # Попробуем встроенный fromisoformat (Python 3.7+)
-        parsed = datetime.datetime.fromisoformat(date_str)
+        return datetime.datetime.fromisoformat(date_str)
     except ValueError:
         # Если не получилось, используем dateutil, который более гибкий
         from dateutil import parser
-        parsed = parser.isoparse(date_str)
-    
-    return parsed.strftime("%d.%m.%Y %H:%M") + " Мск"
+        return parser.isoparse(date_str)
+
+# Дата из БД (timestamptz) -> "27.01.2025 11:35 Мск"
+MSK = datetime.timezone(datetime.timedelta(hours=3))
+
+def format_review_date(dt: datetime.datetime) -> str:
+    if dt is None:
+        return ""
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=datetime.timezone.utc)
+    return dt.astimezone(MSK).strftime("%d.%m.%Y %H:%M") + " Мск"
+
+# Текст отзыва для бота
+def build_review_text(author, formatted_date, rating, advantages, disadvantages, comment,
+                      order_id=None, offer_id=None, offer_name=None, placement_type=None) -> str:
+    review_text = f"Отзыв от {author} ({formatted_date}):\n"
+    review_text += f"Оценка: {rating}/5\n\n"
+    if advantages:
+        review_text += f"Плюсы:\n{advantages}\n\n"
+    if disadvantages:
+        review_text += f"Минусы:\n{disadvantages}\n\n"
+    if comment:
+        review_text += f"Комментарий:\n{comment}"
+
+    if order_id and offer_id and offer_name:
+        review_text += f"\n\nТовар: {offer_name} (SKU: {offer_id})"
+        # Добавим id заказа
+        review_text += f"\nЗаказ №{order_id}"
+        if placement_type:
+            review_text += f"\nМодель работы: {placement_type}"
+    return review_text
+
+# Определяем SKU и название товара по orderId, опрашивая кампании аккаунта параллельно
+ORDER_LOOKUP_CONCURRENCY = int(os.getenv('ORDER_LOOKUP_CONCURRENCY', '5'))
+ORDER_LOOKUP_DEADLINE = float(os.getenv('ORDER_LOOKUP_DEADLINE', '8'))
+
+# Время жизни записей order_offer_cache (в секундах)
+ORDER_CACHE_TTL = int(os.getenv('ORDER_CACHE_TTL', str(30 * 24 * 3600)))
+ORDER_CACHE_NEGATIVE_TTL = int(os.getenv('ORDER_CACHE_NEGATIVE_TTL', str(6 * 3600)))
+
+order_cache_stats = {'hits': 0, 'misses': 0, 'negative_skips': 0}
+
+# lookups — поиски через API, probes — запросы /orders/{id},
+# routed_hits — заказ нашёлся в кампании, выбранной по статистике, с первой попытки
+routing_stats = {'lookups': 0, 'probes': 0, 'routed_lookups': 0, 'routed_hits': 0}
+
+def order_routing_stats() -> dict:
+    lookups = routing_stats['lookups']
+    routed = routing_stats['routed_lookups']
+    return {
+        **routing_stats,
+        'probes_per_lookup': round(routing_stats['probes'] / lookups, 3) if lookups else None,
+        'routed_hit_rate': round(routing_stats['routed_hits'] / routed, 3) if routed else None,
+    }
+
+async def save_order_offer_cache(db: AsyncSession, business_id: str, order_id: int, results: list):
+    """
+    results — список (campaign_id, offer_id, offer_name, placement_type, found).
+    """
+    if not results:
+        return
+    now = datetime.datetime.now(datetime.timezone.utc)
+    rows = [{
+        'business_id': business_id,
+        'order_id': order_id,
+        'campaign_id': campaign_id,
+        'offer_id': offer_id,
+        'offer_name': offer_name,
+        'placement_type': placement_type,
+        'found': found,
+        'fetched_at': now,
+    } for campaign_id, offer_id, offer_name, placement_type, found in results]
+    stmt = pg_insert(OrderOfferCache.__table__).values(rows)
+    excluded = stmt.excluded
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['business_id', 'order_id', 'campaign_id'],
+        set_={
+            'offer_id': excluded.offer_id,
+            'offer_name': excluded.offer_name,
+            'placement_type': excluded.placement_type,
+            'found': excluded.found,
+            'fetched_at': excluded.fetched_at,
+        }
+    )
+    await db.execute(stmt)
+    await db.commit()
+
+async def account_campaigns(account: MarketplaceAccount, db: AsyncSession) -> list:
+    # Кампании, загруженные вместе с кабинетом (load_user_account), повторно не запрашиваем
+    if 'campaigns' not in inspect(account).unloaded:
+        return sorted(account.campaigns, key=lambda camp: (-camp.order_hits, camp.id))
+    return list((await db.scalars(select(Campaign).where(
+        Campaign.marketplace_account_id == account.id
+    ).order_by(Campaign.order_hits.desc(), Campaign.id))).all())
+
+async def resolve_order_offer(account: MarketplaceAccount, order_id: int, db: AsyncSession,
+                              upstream: RequestScope = None):
+    """
+    Возвращает (offer_id, offer_name, placement_type) или (None, None, None).
+    Сначала смотрим в order_offer_cache: свежая положительная запись отвечает сразу,
+    а кампании с свежей отрицательной записью не опрашиваются.
+    Остальные кампании опрашиваются параллельно (не больше ORDER_LOOKUP_CONCURRENCY);
+    как только заказ найден, остальные запросы отменяются. На весь поиск
+    отводится ORDER_LOOKUP_DEADLINE секунд.
+    """
+    if upstream is None:
+        upstream = RequestScope(upstream_flight)
+
+    business_id = account.business_id
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cached = (await db.scalars(select(OrderOfferCache).where(
+        OrderOfferCache.business_id == business_id,
+        OrderOfferCache.order_id == order_id
+    ))).all()
+    skip_campaigns = set()
+    for row in cached:
+        if row.found and row.fetched_at > now - datetime.timedelta(seconds=ORDER_CACHE_TTL):
+            order_cache_stats['hits'] += 1
+            return (row.offer_id, row.offer_name, row.placement_type)
+        if not row.found and row.fetched_at > now - datetime.timedelta(seconds=ORDER_CACHE_NEGATIVE_TTL):
+            skip_campaigns.add(row.campaign_id)
+    order_cache_stats['misses'] += 1
+
+    # Все кампании данного аккаунта: сначала те, где заказы находились чаще
+    campaigns = await account_campaigns(account, db)
+    order_cache_stats['negative_skips'] += sum(1 for camp in campaigns if camp.campaign_id in skip_campaigns)
+    campaigns = [camp for camp in campaigns if camp.campaign_id not in skip_campaigns]
+    if not campaigns:
+        return (None, None, None)
+
+    # Если есть статистика, сначала спрашиваем самую вероятную кампанию одну,
+    # и только при промахе — все остальные параллельно
+    routed = campaigns[0].order_hits > 0 and len(campaigns) > 1
+    waves = [campaigns[:1], campaigns[1:]] if routed else [campaigns]
+    routing_stats['lookups'] += 1
+    if routed:
+        routing_stats['routed_lookups'] += 1
+
+    semaphore = asyncio.Semaphore(ORDER_LOOKUP_CONCURRENCY)
+
+    async def probe(camp):
+        async with semaphore:
+            routing_stats['probes'] += 1
+            # пытаемся найти заказ в данной кампании
+            oi, oname, not_found = await upstream.call(
+                ('order_item', camp.campaign_id, order_id),
+                lambda: get_item_info_yandex(account.api_key, camp.campaign_id, order_id)
+            )
+        return camp, oi, oname, not_found
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + ORDER_LOOKUP_DEADLINE
+    found = (None, None, None)
+    found_campaign = None
+    to_cache = []
+    for wave_number, wave in enumerate(waves):
+        tasks = [asyncio.ensure_future(probe(camp)) for camp in wave]
+        pending = set(tasks)
+        try:
+            while pending and not found_campaign:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    print(f"Order lookup deadline exceeded for order {order_id}")
+                    break
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.cancelled():
+                        # Общий запрос single-flight отменили: эта кампания остаётся без ответа
+                        continue
+                    if task.exception():
+                        print(f"Error in order lookup for order {order_id}: {task.exception()}")
+                        continue
+                    camp, oi, oname, not_found = task.result()
+                    if oi and oname:
+                        found = (oi, oname, camp.placement_type)  # "FBY", "FBS" и т.д.
+                        found_campaign = camp
+                        to_cache.append((camp.campaign_id, oi, oname, camp.placement_type, True))
+                    elif not_found:
+                        to_cache.append((camp.campaign_id, None, None, camp.placement_type, False))
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+        if found_campaign or loop.time() >= deadline:
+            break
+
+    if found_campaign:
+        if routed and wave_number == 0:
+            routing_stats['routed_hits'] += 1
+        # Атомарно увеличиваем счётчик попаданий кампании
+        await db.execute(update(Campaign).where(Campaign.id == found_campaign.id).values(
+            order_hits=Campaign.order_hits + 1
+        ).execution_options(synchronize_session=False))
+    await save_order_offer_cache(db, business_id, order_id, to_cache)
+    await db.commit()
+    return found
 
 # функция получения отзыва
-def get_last_review_yandex(account: MarketplaceAccount, page_token: str, db: Session):
+async def get_last_review_yandex(account: MarketplaceAccount, page_token: str, db: AsyncSession,
+                                 upstream: RequestScope = None):
     """
     Получает последний отзыв с Яндекс.Маркета (goods-feedback) для данного account.
     Если находим orderId в отзыве, пытаемся определить SKU и название товара,
     пройдя по всем кампаниям данного аккаунта.
+    Вызовы API идут через upstream (single-flight), чтобы одинаковые запросы не дублировались.
+    Используется, пока отзывы аккаунта ещё не загружены в таблицу reviews.
     """
-
-    token = account.api_key
-    headers = {
-        'Authorization': f'Bearer {token}',
-        'Content-Type': 'application/json'
-    }
+    if upstream is None:
+        upstream = RequestScope(upstream_flight)
 
     business_id = account.business_id
     if not business_id:
-        return ("Ошибка: business_id не найден", None, None)
-
-    # URL для получения отзывов
-    url = f'https://api.partner.market.yandex.ru/v2/businesses/{business_id}/goods-feedback'
-    
-    # Параметры запроса
-    params = {
-        'limit': 1  # берем 1 отзыв
-    }
-    if page_token:
-        params['page_token'] = page_token
-    
-    data = {
-        'reactionStatus': 'NEED_REACTION',
-        'paid': False
-    }
+        return ("Ошибка: business_id не найден", None, None, {})
 
-    response = requests.post(url, headers=headers, params=params, json=data)
-    if response.status_code != 200:
-        return (f"Ошибка при получении отзыва: {response.status_code}, {response.text}", None, None)
+    # берем 1 отзыв
+    page = await upstream.call(
+        ('goods_feedback', business_id, page_token, 1),
+        lambda: yandex_client.get_goods_feedback(account.api_key, business_id, limit=1, page_token=page_token)
+    )
+    if not page.response.ok:
+        return (f"Ошибка при получении отзыва: {page.response.status}, {page.response.text}", None, None, {})
 
-    data = response.json()
-    feedbacks = data.get('result', {}).get('feedbacks', [])
-    next_page_token = data.get('result', {}).get('paging', {}).get('nextPageToken')
+    feedbacks = page.feedbacks
+    next_page_token = page.next_page_token
 
     if not feedbacks:
-        return ("Нет доступных отзывов.", None, None)
+        return ("Нет доступных отзывов.", None, None, {})
 
     # Берём первый (последний) отзыв
     last_feedback = feedbacks[0]
@@ -536,41 +1099,14 @@ def get_last_review_yandex(account: MarketplaceAccount, page_token: str, db: Ses
     media = last_feedback.get('media', {})
     photos = media.get('photos', [])
 
-    # Базовый текст отзыва
-    review_text = f"Отзыв от {author} ({formatted_date}):\n"
-    review_text += f"Оценка: {rating}/5\n\n"
-    if advantages:
-        review_text += f"Плюсы:\n{advantages}\n\n"
-    if disadvantages:
-        review_text += f"Минусы:\n{disadvantages}\n\n"
-    if comment:
-        review_text += f"Комментарий:\n{comment}"
-
-    # Новая логика: ищем SKU и название товара
+    # ищем SKU и название товара
     order_id = last_feedback.get('identifiers', {}).get('orderId')
+    offer_id = offer_name = placement_type = None
     if order_id:
-        # Достаём все кампании данного аккаунта
-        campaigns = db.query(Campaign).filter(Campaign.marketplace_account_id == account.id).all()
+        offer_id, offer_name, placement_type = await resolve_order_offer(account, order_id, db, upstream)
 
-        offer_id = None
-        offer_name = None
-        placement_type = None
-
-        for camp in campaigns:
-            # пытаемся найти заказ в данной кампании
-            oi, oname = get_item_info_yandex(account.api_key, camp.campaign_id, order_id)
-            if oi and oname:
-                offer_id = oi
-                offer_name = oname
-                placement_type = camp.placement_type  # "FBY", "FBS" и т.д.
-                break
-
-        if offer_id and offer_name:
-            review_text += f"\n\nТовар: {offer_name} (SKU: {offer_id})"
-            # Добавим id заказа
-            review_text += f"\nЗаказ №{order_id}"
-            if placement_type:
-                review_text += f"\nМодель работы: {placement_type}"
+    review_text = build_review_text(author, formatted_date, rating, advantages, disadvantages, comment,
+                                    order_id, offer_id, offer_name, placement_type)
 
     short_data = {
         "author": author,
@@ -578,43 +1114,489 @@ def get_last_review_yandex(account: MarketplaceAccount, page_token: str, db: Ses
         "disadvantages": disadvantages,
         "comment": comment,
         "product_name": offer_name,
+        "rating": rating,
         "photos": photos,
         "seller_name": account.account_name
         }
 
     return (review_text, review_id, next_page_token, short_data)
 
+# Курсор для постраничного просмотра локальных отзывов: "<created_at в мкс>:<id>"
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+def encode_review_cursor(review: 'Review') -> str:
+    created_at = review.created_at
+    if created_at.tzinfo is None:
+        created_at = created_at.replace(tzinfo=datetime.timezone.utc)
+    micros = (created_at - EPOCH) // datetime.timedelta(microseconds=1)
+    return f"{micros}:{review.id}"
 
-def get_item_info_yandex(api_key: str, campaign_id: int, order_id: int):
+def decode_review_cursor(page_token: str):
+    try:
+        micros, review_pk = page_token.split(':')
+        return (EPOCH + datetime.timedelta(microseconds=int(micros)), int(review_pk))
+    except (AttributeError, ValueError):
+        # Пустой или старый (яндексовский) токен — начинаем сначала
+        return None
+
+# Отзыв из локальной таблицы reviews
+async def get_review_from_db(account: MarketplaceAccount, page_token: str, db: AsyncSession,
+                             upstream: RequestScope = None):
     """
-    Пытается сделать GET /campaigns/{campaignId}/orders/{orderId}
-    Если удаётся найти items, возвращаем (offerId, offerName) (первый item, для примера).
-    Если не найден, возвращаем (None, None).
+    Возвращает тот же кортеж, что и get_last_review_yandex, но читает отзыв из Postgres.
+    Если отзывы бизнеса ещё ни разу не загружались, возвращает None.
+    """
+    business_id = account.business_id
+    if not business_id:
+        return ("Ошибка: business_id не найден", None, None, {})
+
+    # Загрузка могла завершиться и без единого отзыва: смотрим на отметку, а не на строки reviews
+    if not await db.scalar(select(ReviewSync.business_id).where(ReviewSync.business_id == business_id)):
+        return None
+
+    query = select(Review).where(
+        Review.business_id == business_id,
+        Review.reaction_status == 'NEED_REACTION'
+    )
+    cursor = decode_review_cursor(page_token)
+    if cursor:
+        query = query.where(tuple_(Review.created_at, Review.id) < cursor)
+    # Берём на один больше, чтобы понять, есть ли следующая страница
+    rows = (await db.scalars(query.order_by(Review.created_at.desc(), Review.id.desc()).limit(2))).all()
+
+    if not rows:
+        return ("Нет доступных отзывов.", None, None, {})
+
+    review = rows[0]
+    next_page_token = encode_review_cursor(review) if len(rows) > 1 else None
+
+    if await enrich_review(review, account, db, upstream):
+        await db.commit()
+
+    rating = review.rating if review.rating is not None else 'Нет оценки'
+    review_text = build_review_text(review.author, format_review_date(review.created_at), rating,
+                                    review.advantages, review.disadvantages, review.comment,
+                                    review.order_id, review.offer_id, review.offer_name, review.placement_type)
+
+    short_data = review_short_data(review, account)
+    # Заранее сгенерированный ответ (см. generate_review_drafts)
+    short_data['draft_reply'] = review.draft_reply
+
+    return (review_text, review.feedback_id, next_page_token, short_data)
+
+# SKU и название товара определяем один раз и сохраняем в строке отзыва
+async def enrich_review(review: 'Review', account: MarketplaceAccount, db: AsyncSession,
+                        upstream: RequestScope = None) -> bool:
+    """
+    Возвращает True, если строка отзыва изменилась и её нужно сохранить.
     """
-    headers = {
-        'Authorization': f'Bearer {api_key}',
-        'Content-Type': 'application/json'
+    if not review.order_id or review.enriched:
+        return False
+    offer_id, offer_name, placement_type = await resolve_order_offer(account, review.order_id, db, upstream)
+    if not (offer_id and offer_name):
+        return False
+    review.offer_id = offer_id
+    review.offer_name = offer_name
+    review.placement_type = placement_type
+    review.enriched = True
+    return True
+
+def review_short_data(review: 'Review', account: MarketplaceAccount) -> dict:
+    return {
+        "author": review.author,
+        "advantages": review.advantages or '',
+        "disadvantages": review.disadvantages or '',
+        "comment": review.comment or '',
+        "product_name": review.offer_name,
+        "rating": review.rating,
+        "photos": review.photos or [],
+        "seller_name": account.account_name
+        }
+
+# Фоновая загрузка отзывов в таблицу reviews
+REVIEW_INGEST_INTERVAL = int(os.getenv('REVIEW_INGEST_INTERVAL', '60'))
+REVIEW_INGEST_PAGE_SIZE = int(os.getenv('REVIEW_INGEST_PAGE_SIZE', '50'))
+REVIEW_INGEST_MAX_PAGES = int(os.getenv('REVIEW_INGEST_MAX_PAGES', '20'))
+
+# business_id, по которым загрузка уже идёт в этом процессе
+_ingesting_businesses = set()
+
+def feedback_to_review_row(business_id: str, feedback: dict, synced_at: datetime.datetime) -> dict:
+    description = feedback.get('description', {})
+    raw_date = feedback.get('createdAt')
+    return {
+        'business_id': business_id,
+        'feedback_id': feedback.get('feedbackId'),
+        'author': feedback.get('author', 'Неизвестный автор'),
+        'advantages': description.get('advantages', ''),
+        'disadvantages': description.get('disadvantages', ''),
+        'comment': description.get('comment', ''),
+        'rating': feedback.get('statistics', {}).get('rating'),
+        'order_id': feedback.get('identifiers', {}).get('orderId'),
+        'photos': feedback.get('media', {}).get('photos', []),
+        'created_at': parse_yandex_date(raw_date) if raw_date else synced_at,
+        'reaction_status': 'NEED_REACTION',
+        'synced_at': synced_at,
     }
-    url = f"https://api.partner.market.yandex.ru/campaigns/{campaign_id}/orders/{order_id}"
-
-    resp = requests.get(url, headers=headers)
-    if resp.status_code == 200:
-        data = resp.json()
-        items = data.get('order', {}).get('items', [])
-        if items:
-            item = items[0]
-            offer_id = item.get('offerId')
-            offer_name = item.get('offerName')
-            return (offer_id, offer_name)
-        else:
-            return (None, None)
+
+async def upsert_reviews(db: AsyncSession, rows: list):
+    if not rows:
+        return
+    stmt = pg_insert(Review.__table__).values(rows)
+    excluded = stmt.excluded
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['business_id', 'feedback_id'],
+        set_={
+            'author': excluded.author,
+            'advantages': excluded.advantages,
+            'disadvantages': excluded.disadvantages,
+            'comment': excluded.comment,
+            'rating': excluded.rating,
+            'order_id': excluded.order_id,
+            'photos': excluded.photos,
+            'created_at': excluded.created_at,
+            'synced_at': excluded.synced_at,
+            # Ответ, уже отправленный через бота, не возвращаем в очередь
+            'reaction_status': case(
+                (Review.__table__.c.reaction_status == 'REPLIED', 'REPLIED'),
+                else_=excluded.reaction_status
+            ),
+        }
+    )
+    await db.execute(stmt)
+    await db.commit()
+
+async def ingest_business_reviews(account: MarketplaceAccount, db: AsyncSession) -> int:
+    """
+    Загружает отзывы NEED_REACTION бизнеса большими страницами и сохраняет их в reviews.
+    Если удалось пройти все страницы, отзывы, пропавшие из выдачи, помечаются как REACTED.
+    Без ошибок API бизнес отмечается в review_syncs, и отзывы дальше читаются из БД.
+    """
+    business_id = account.business_id
+    synced_at = datetime.datetime.now(datetime.timezone.utc)
+    page_token = None
+    total = 0
+
+    for _ in range(REVIEW_INGEST_MAX_PAGES):
+        page = await yandex_client.get_goods_feedback(account.api_key, business_id,
+                                                      limit=REVIEW_INGEST_PAGE_SIZE, page_token=page_token)
+        if not page.response.ok:
+            print(f"Error ingesting reviews for business {business_id}: {page.response.status}, {page.response.text}")
+            return total
+
+        rows = [feedback_to_review_row(business_id, fb, synced_at) for fb in page.feedbacks if fb.get('feedbackId')]
+        await upsert_reviews(db, rows)
+        total += len(rows)
+
+        page_token = page.next_page_token
+        if not page_token or not page.feedbacks:
+            break
     else:
-        # заказ не найден в этой кампании (или нет доступа)
-        return (None, None)
+        # Дошли до лимита страниц — не знаем, что осталось, пропавшие не помечаем
+        await mark_business_synced(db, business_id, synced_at)
+        return total
+
+    await db.execute(update(Review).where(
+        Review.business_id == business_id,
+        Review.reaction_status == 'NEED_REACTION',
+        Review.synced_at < synced_at
+    ).values(reaction_status='REACTED').execution_options(synchronize_session=False))
+    await mark_business_synced(db, business_id, synced_at)
+    return total
+
+async def mark_business_synced(db: AsyncSession, business_id: str, synced_at: datetime.datetime):
+    stmt = pg_insert(ReviewSync.__table__).values(business_id=business_id, synced_at=synced_at)
+    stmt = stmt.on_conflict_do_update(index_elements=['business_id'], set_={'synced_at': stmt.excluded.synced_at})
+    await db.execute(stmt)
+    await db.commit()
+
+# Пространства имён advisory-блокировок Postgres (первый аргумент pg_try_advisory_lock)
+LOCK_REVIEW_INGEST = 1
+LOCK_REVIEW_DRAFTS = 2
+
+@asynccontextmanager
+async def advisory_lock(namespace: int, name: str):
+    """
+    Неблокирующая advisory-блокировка Postgres, общая для всех процессов и реплик.
+    Отдаёт True, если блокировка взята, и False, если её держит другой процесс.
+    Блокировка сессионная, поэтому держим под неё отдельное соединение.
+    """
+    params = {'namespace': namespace, 'name': name}
+    async with async_engine.connect() as conn:
+        acquired = await conn.scalar(text('SELECT pg_try_advisory_lock(:namespace, hashtext(:name))'), params)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                await conn.execute(text('SELECT pg_advisory_unlock(:namespace, hashtext(:name))'), params)
+
+async def ingest_business_once(account: MarketplaceAccount, db: AsyncSession) -> bool:
+    """
+    Загружает отзывы бизнеса, если их сейчас не загружает этот или другой процесс
+    (несколько воркеров uvicorn иначе тратили бы квоту Маркета на одно и то же).
+    """
+    business_id = account.business_id
+    if business_id in _ingesting_businesses:
+        return False
+    _ingesting_businesses.add(business_id)
+    try:
+        async with advisory_lock(LOCK_REVIEW_INGEST, business_id) as acquired:
+            if not acquired:
+                return False
+            await ingest_business_reviews(account, db)
+            return True
+    finally:
+        _ingesting_businesses.discard(business_id)
+
+async def ingest_business_reviews_by_id(account_id: int):
+    # Задача запускается из запроса, но в его бюджет запросов не входит
+    with uncounted():
+        try:
+            async with AsyncSessionLocal() as db:
+                account = await db.get(MarketplaceAccount, account_id)
+                if account and account.business_id:
+                    await ingest_business_once(account, db)
+        except Exception as e:
+            print(f"Error in review ingestion: {e}")
+
+async def ingest_all_reviews():
+    async with AsyncSessionLocal() as db:
+        accounts = (await db.scalars(select(MarketplaceAccount).where(
+            MarketplaceAccount.marketplace == 'Яндекс.Маркет',
+            MarketplaceAccount.business_id.isnot(None)
+        ).order_by(MarketplaceAccount.id))).all()
+
+        # Один проход на бизнес, даже если кабинет добавлен несколькими сотрудниками
+        seen = set()
+        for account in accounts:
+            business_id = account.business_id
+            if business_id in seen:
+                continue
+            seen.add(business_id)
+            try:
+                await ingest_business_once(account, db)
+            except Exception as e:
+                await db.rollback()
+                print(f"Error ingesting reviews for business {business_id}: {e}")
+
+# Заранее генерируем ответы для отзывов, ожидающих реакции
+DRAFT_CONCURRENCY = int(os.getenv('DRAFT_CONCURRENCY', '4'))
+DRAFT_BATCH_SIZE = int(os.getenv('DRAFT_BATCH_SIZE', '50'))
+
+async def save_review_draft(db: AsyncSession, business_id: str, feedback_id: int, reply: str):
+    await db.execute(update(Review).where(
+        Review.business_id == business_id,
+        Review.feedback_id == feedback_id
+    ).values(
+        draft_reply=reply, draft_generated_at=datetime.datetime.now(datetime.timezone.utc)
+    ).execution_options(synchronize_session=False))
+    await db.commit()
+
+async def generate_review_drafts() -> int:
+    """
+    Генерирует ответы для отзывов NEED_REACTION без черновика (не более DRAFT_BATCH_SIZE за проход).
+    Отзывы уходят к OpenAI пакетами по REPLY_BATCH_SIZE, одновременно не больше DRAFT_CONCURRENCY запросов.
+    Проход выполняет один процесс: остальные воркеры выбрали бы те же отзывы и оплатили бы их повторно.
+    """
+    async with advisory_lock(LOCK_REVIEW_DRAFTS, 'drafts') as acquired:
+        if not acquired:
+            return 0
+        return await _generate_review_drafts()
+
+async def _generate_review_drafts() -> int:
+    async with AsyncSessionLocal() as db:
+        reviews = (await db.scalars(select(Review).where(
+            Review.reaction_status == 'NEED_REACTION',
+            Review.draft_reply.is_(None)
+        ).order_by(Review.created_at.desc(), Review.id.desc()).limit(DRAFT_BATCH_SIZE))).all()
+        if not reviews:
+            return 0
+
+        accounts = {}
+        # Пользователя и кампании подгружаем сразу: ленивая загрузка в асинхронной сессии недоступна
+        for account in (await db.scalars(select(MarketplaceAccount).options(
+            selectinload(MarketplaceAccount.user), selectinload(MarketplaceAccount.campaigns)
+        ).where(
+            MarketplaceAccount.business_id.in_({r.business_id for r in reviews})
+        ).order_by(MarketplaceAccount.id))).all():
+            accounts.setdefault(account.business_id, account)
+
+        # Сначала SKU и название товара: они попадают в промпт
+        upstream = RequestScope(upstream_flight)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        generated = 0
+        pending = []
+        for review in reviews:
+            account = accounts.get(review.business_id)
+            if not account:
+                continue
+            await enrich_review(review, account, db, upstream)
+            short_data = review_short_data(review, account)
+            # Пустые отзывы с высокой оценкой — по шаблону, одинаковые — из кэша
+            cached = (await template_reply(short_data, account.user.company_id, db)
+                      or await lookup_cached_reply(short_data, db))
+            if cached:
+                review.draft_reply = cached
+                review.draft_generated_at = now
+                generated += 1
+            else:
+                pending.append((review, short_data))
+        await db.commit()
+
+        semaphore = asyncio.Semaphore(DRAFT_CONCURRENCY)
+
+        async def generate(short_datas):
+            async with semaphore:
+                return await generate_replies_batch(short_datas)
+
+        # Несколько отзывов на один запрос к LLM
+        chunks = [[short_data for _, short_data in pending[i:i + REPLY_BATCH_SIZE]]
+                  for i in range(0, len(pending), REPLY_BATCH_SIZE)]
+        replies = [reply for chunk_replies in await asyncio.gather(*(generate(chunk) for chunk in chunks))
+                   for reply in chunk_replies]
+
+        now = datetime.datetime.now(datetime.timezone.utc)
+        for (review, short_data), reply in zip(pending, replies):
+            if reply and reply != REPLY_GENERATION_FAILED:
+                await store_cached_reply(short_data, reply, db)
+                review.draft_reply = reply
+                review.draft_generated_at = now
+                generated += 1
+        await db.commit()
+        return generated
+
+async def review_ingestion_loop():
+    while True:
+        try:
+            await ingest_all_reviews()
+        except Exception as e:
+            print(f"Error in review ingestion: {e}")
+        try:
+            await generate_review_drafts()
+        except Exception as e:
+            print(f"Error in draft generation: {e}")
+        try:
+            await purge_reply_cache()
+        except Exception as e:
+            print(f"Error purging reply cache: {e}")
+        await asyncio.sleep(REVIEW_INGEST_INTERVAL)
+
+
+async def get_item_info_yandex(api_key: str, campaign_id: int, order_id: int):
+    """
+    Пытается сделать GET /campaigns/{campaignId}/orders/{orderId}
+    Если удаётся найти items, возвращаем (offerId, offerName, False) (первый item, для примера).
+    Если не найден, возвращаем (None, None, not_found), где not_found=True означает
+    окончательный ответ (заказа в кампании нет), а False — временную ошибку.
+    """
+    result = await yandex_client.get_order_item(api_key, campaign_id, order_id)
+    if result.item:
+        return (result.item.offer_id, result.item.offer_name, False)
+    # заказ не найден в этой кампании (или нет доступа)
+    return (None, None, result.not_found)
     
 
-# Cинхронная функция для генерации ответа на отзыв
-def generate_reply_to_review(short_data: dict) -> str:
+REPLY_GENERATION_FAILED = "Не удалось сгенерировать ответ на отзыв."
+
+# Шаблонные ответы для пустых отзывов с высокой оценкой (без LLM)
+REPLY_TEMPLATES_TTL = int(os.getenv('REPLY_TEMPLATES_TTL', '300'))
+
+company_templates_cache = TTLCache(maxsize=1024, ttl=REPLY_TEMPLATES_TTL)
+template_stats = {'checked': 0, 'fast_path': 0}
+
+async def get_company_templates(company_id: int, db: AsyncSession) -> list:
+    templates = company_templates_cache.get(company_id)
+    if templates is None:
+        rows = (await db.scalars(
+            select(ReplyTemplate).where(ReplyTemplate.company_id == company_id)
+        )).all() if company_id else []
+        templates = [(row.min_rating, row.max_rating, row.product_name, row.text) for row in rows]
+        if not templates:
+            templates = [(min_rating, max_rating, None, text) for min_rating, max_rating, text in DEFAULT_TEMPLATES]
+        company_templates_cache.set(company_id, templates)
+    return templates
+
+async def template_reply(short_data: dict, company_id: int, db: AsyncSession):
+    """
+    Ответ по шаблону компании для тривиального отзыва или None, если нужна LLM.
+    """
+    template_stats['checked'] += 1
+    if not is_trivial_review(short_data):
+        return None
+    reply = pick_template(await get_company_templates(company_id, db), short_data)
+    if reply:
+        template_stats['fast_path'] += 1
+    return reply
+
+# Кэш ответов на одинаковые отзывы: в памяти (LRU) и в таблице reply_cache
+REPLY_CACHE_TTL = int(os.getenv('REPLY_CACHE_TTL', str(7 * 24 * 3600)))
+REPLY_CACHE_MEMORY_TTL = int(os.getenv('REPLY_CACHE_MEMORY_TTL', '3600'))
+REPLY_CACHE_SIZE = int(os.getenv('REPLY_CACHE_SIZE', '4096'))
+REPLY_POOL_SIZE = int(os.getenv('REPLY_POOL_SIZE', '3'))
+
+reply_pool_cache = ReplyPoolCache(pool_size=REPLY_POOL_SIZE, maxsize=REPLY_CACHE_SIZE, ttl=REPLY_CACHE_MEMORY_TTL)
+reply_cache_stats = {'hits': 0, 'misses': 0}
+
+async def lookup_cached_reply(short_data: dict, db: AsyncSession):
+    """
+    Возвращает ответ из пула, если для такого отзыва уже накоплено REPLY_POOL_SIZE вариантов,
+    иначе None (нужно сгенерировать новый вариант).
+    """
+    key = reply_cache_key(short_data)
+    pool = reply_pool_cache.get_pool(key)
+    if pool is None:
+        # Подгружаем пул из Postgres
+        since = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=REPLY_CACHE_TTL)
+        replies = (await db.scalars(select(ReplyCacheEntry.reply).where(
+            ReplyCacheEntry.key_hash == key,
+            ReplyCacheEntry.created_at > since
+        ).order_by(ReplyCacheEntry.created_at))).all()
+        reply_pool_cache.set_pool(key, list(replies))
+        pool = reply_pool_cache.get_pool(key)
+
+    if reply_pool_cache.is_full(pool):
+        reply_cache_stats['hits'] += 1
+        return render_template(reply_pool_cache.next_template(pool), short_data.get('author'))
+    reply_cache_stats['misses'] += 1
+    return None
+
+async def store_cached_reply(short_data: dict, reply: str, db: AsyncSession):
+    if not reply or reply == REPLY_GENERATION_FAILED:
+        return
+    key = reply_cache_key(short_data)
+    template = to_template(reply, short_data.get('author'))
+    if template is None:
+        return
+    reply_pool_cache.add(key, template)
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    # Заодно удаляем устаревшие варианты этого ключа
+    await db.execute(delete(ReplyCacheEntry).where(
+        ReplyCacheEntry.key_hash == key,
+        ReplyCacheEntry.created_at <= now - datetime.timedelta(seconds=REPLY_CACHE_TTL)
+    ).execution_options(synchronize_session=False))
+    db.add(ReplyCacheEntry(key_hash=key, reply=template, created_at=now))
+    await db.commit()
+
+async def purge_reply_cache() -> int:
+    # Ключи, которые больше не встречаются, сами не удалятся: чистим все устаревшие варианты
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=REPLY_CACHE_TTL)
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(delete(ReplyCacheEntry).where(
+            ReplyCacheEntry.created_at <= cutoff
+        ).execution_options(synchronize_session=False))
+        await db.commit()
+        return result.rowcount
+
+REPLY_SYSTEM_PROMPT = (
+    "Ты эксперт по управлению репутацией брендов. Ты пишешь ответы на отзывы клиентов продавца на маркетплейсах. "
+    "Ответы должны акцентировать внимание на положительных качествах товара, развивая их и минимизируя негатив, "
+    "предлагая альтернативы. Все для укрепления доверия потенциальных покупателей."
+)
+REPLY_MAX_LENGTH = 280
+
+# Короткий текст отзыва для промпта
+def build_review_prompt(short_data: dict) -> str:
     author = short_data.get('author') or "Неизвестно"
     pluses = short_data.get('advantages') or ""
     minuses = short_data.get('disadvantages') or ""
@@ -622,7 +1604,6 @@ def generate_reply_to_review(short_data: dict) -> str:
     product_name = short_data.get('product_name') or "неизвестный товар"
     seller_name = short_data.get('seller_name') or "неизвестном продавце"
 
-    # Сформируем короткий текст отзыва
     user_prompt = f"Отзыв от {author} о товаре '{product_name}' у продавца '{seller_name}':\n"
     if pluses:
         user_prompt += f"Плюсы: {pluses}\n"
@@ -630,41 +1611,114 @@ def generate_reply_to_review(short_data: dict) -> str:
         user_prompt += f"Минусы: {minuses}\n"
     if comment:
         user_prompt += f"Комментарий: {comment}\n"
+    return user_prompt
 
-    messages = [
+def build_reply_messages(short_data: dict) -> list:
+    user_prompt = build_review_prompt(short_data)
+
+    return [
         {
             "role": "system",
-            "content": (
-                "Ты эксперт по управлению репутацией брендов. Ты пишешь ответы на отзывы клиентов продавца на маркетплейсах. "
-                "Ответы должны акцентировать внимание на положительных качествах товара, развивая их и минимизируя негатив, "
-                "предлагая альтернативы. Все для укрепления доверия потенциальных покупателей."
-            )
+            "content": REPLY_SYSTEM_PROMPT
         },
         {
             "role": "user",
             "content": (
                 f"{user_prompt}\n"
-                "Сгенерируй вежливый и профессиональный ответ на отзыв клиента, не более 280 символов."
+                f"Сгенерируй вежливый и профессиональный ответ на отзыв клиента, не более {REPLY_MAX_LENGTH} символов."
             )
         }
     ]
 
+# Генерация ответа на отзыв через общий шлюз к LLM
+async def generate_reply_to_review(short_data: dict) -> str:
+    messages = build_reply_messages(short_data)
+
     try:
-        response = openai.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=messages,
-            max_tokens=280,
-            temperature=0.8,
-        )
-        reply = response.choices[0].message.content.strip()
+        reply = await llm_gateway.complete(messages, max_tokens=280, temperature=0.8)
         return reply
     except Exception as e:
         print(f"Error in generate_reply_to_review: {e}")
-        return "Не удалось сгенерировать ответ на отзыв."
-    
+        return REPLY_GENERATION_FAILED
+
+# Сколько отзывов отправлять в одном запросе к LLM
+REPLY_BATCH_SIZE = int(os.getenv('REPLY_BATCH_SIZE', '10'))
+
+def parse_batch_replies(content: str, count: int) -> list:
+    """
+    Разбирает ответ вида {"replies": [{"id": 1, "reply": "..."}, ...]}.
+    Возвращает список длины count; на месте отсутствующих или некорректных ответов — None.
+    """
+    replies = [None] * count
+    try:
+        items = json.loads(content).get('replies', [])
+    except (ValueError, AttributeError):
+        return replies
+    if not isinstance(items, list):
+        return replies
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        index = item.get('id')
+        reply = item.get('reply')
+        if not isinstance(index, int) or not 1 <= index <= count:
+            continue
+        if not isinstance(reply, str) or not reply.strip():
+            continue
+        # Заметно длиннее лимита — скорее всего, модель склеила ответы
+        if len(reply) > REPLY_MAX_LENGTH * 2:
+            continue
+        replies[index - 1] = reply.strip()
+    return replies
+
+# Генерация ответов сразу на несколько отзывов
+async def generate_replies_batch(short_datas: list) -> list:
+    """
+    Генерирует ответы на несколько отзывов одним запросом к LLM (JSON-ответ).
+    Для отзывов, ответ на которые не удалось разобрать, вызывается generate_reply_to_review.
+    """
+    if not short_datas:
+        return []
+    if len(short_datas) == 1:
+        return [await generate_reply_to_review(short_datas[0])]
+
+    reviews_prompt = "\n".join(
+        f"[{index}] {build_review_prompt(short_data)}" for index, short_data in enumerate(short_datas, start=1)
+    )
+    messages = [
+        {
+            "role": "system",
+            "content": REPLY_SYSTEM_PROMPT
+        },
+        {
+            "role": "user",
+            "content": (
+                f"{reviews_prompt}\n"
+                f"Сгенерируй вежливый и профессиональный ответ на каждый из {len(short_datas)} отзывов, "
+                f"каждый не более {REPLY_MAX_LENGTH} символов. "
+                'Верни JSON вида {"replies": [{"id": <номер отзыва>, "reply": "<ответ>"}]}.'
+            )
+        }
+    ]
+
+    replies = [None] * len(short_datas)
+    try:
+        content = await llm_gateway.complete(messages, max_tokens=280 * len(short_datas), temperature=0.8,
+                                             response_format={"type": "json_object"})
+        replies = parse_batch_replies(content, len(short_datas))
+    except Exception as e:
+        print(f"Error in generate_replies_batch: {e}")
+
+    # По одному догенерируем то, что не получилось в пакете
+    missing = [index for index, reply in enumerate(replies) if not reply]
+    fallback = await asyncio.gather(*(generate_reply_to_review(short_datas[index]) for index in missing))
+    for index, reply in zip(missing, fallback):
+        replies[index] = reply
+    return replies
+
 # Эндпоинт для 
 @app.post('/send_reply')
-async def send_reply(data: dict = Body(...), db: Session = Depends(get_db)):
+async def send_reply(data: dict = Body(...), db: AsyncSession = Depends(get_db)):
     telegram_id = data.get('telegram_id')
     account_id = data.get('account_id')
     reply_text = data.get('reply')
@@ -674,61 +1728,119 @@ async def send_reply(data: dict = Body(...), db: Session = Depends(get_db)):
     if not all([telegram_id, account_id, reply_text, review_id]):
         raise HTTPException(status_code=400, detail='Missing required data')
 
-    # Остальной код без изменений
-    user = db.query(User).filter(User.telegram_id == telegram_id).first()
-    if not user:
-        raise HTTPException(status_code=400, detail='User not authorized')
+    account = await load_user_account(telegram_id, account_id, db)
 
-    account = db.query(MarketplaceAccount).filter(
-        MarketplaceAccount.id == account_id,
-        MarketplaceAccount.user_id == user.id
-    ).first()
-    if not account:
-        raise HTTPException(status_code=400, detail='Marketplace account not found')
+    await send_marketplace_reply(account, review_id, reply_text)
+    await mark_review_replied(db, account, review_id)
+    await db.commit()
+    return {'status': 'success'}
 
-    if account.marketplace == 'Яндекс.Маркет':
-        success = send_reply_to_yandex_market(account, review_id, reply_text)
-        if success:
-            return {'status': 'success'}
+# Сколько ответов одного бизнеса отправляется одновременно в /send_replies
+SEND_REPLIES_PER_BUSINESS = int(os.getenv('SEND_REPLIES_PER_BUSINESS', '4'))
+SEND_REPLIES_MAX_ITEMS = int(os.getenv('SEND_REPLIES_MAX_ITEMS', '500'))
+
+# Положительный id из тела запроса (число или строка из цифр) в пределах колонки; иначе None
+def parse_id(value, limit: int = 2 ** 31) -> Optional[int]:
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        return None
+    try:
+        value = int(value)
+    except ValueError:
+        return None
+    return value if 0 < value < limit else None
+
+# Эндпоинт для пакетной отправки ответов
+@app.post('/send_replies')
+async def send_replies(data: dict = Body(...), db: AsyncSession = Depends(get_db)):
+    """
+    Принимает {"telegram_id": ..., "items": [{"account_id", "review_id", "reply"}, ...]}
+    и возвращает статус по каждому элементу в том же порядке.
+    """
+    telegram_id = data.get('telegram_id')
+    items = data.get('items')
+    if not telegram_id or not isinstance(items, list) or not items:
+        raise HTTPException(status_code=400, detail='Missing required data')
+    telegram_id = parse_id(telegram_id, limit=2 ** 63)
+    if telegram_id is None:
+        raise HTTPException(status_code=400, detail='Invalid telegram_id')
+    if len(items) > SEND_REPLIES_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f'Too many items (max {SEND_REPLIES_MAX_ITEMS})')
+
+    user = await get_authorized_user(telegram_id, db)
+
+    # Сначала проверки (те же, что в /send_reply), затем отправка
+    results = []
+    prepared = []
+    accounts = {}
+    for index, item in enumerate(items):
+        item = item if isinstance(item, dict) else {}
+        account_id = item.get('account_id')
+        review_id = item.get('review_id')
+        reply_text = item.get('reply')
+        results.append({'account_id': account_id, 'review_id': review_id, 'status': 'success'})
+        try:
+            if not all([account_id, reply_text, review_id]):
+                raise HTTPException(status_code=400, detail='Missing required data')
+            # Тело не проходит валидацию FastAPI: некорректный id не должен ронять весь пакет
+            account_id = parse_id(account_id)
+            if account_id is None:
+                raise HTTPException(status_code=400, detail='Invalid account_id')
+            if account_id not in accounts:
+                accounts[account_id] = await get_user_account(user['id'], account_id, db)
+            prepared.append((index, accounts[account_id], review_id, reply_text))
+        except HTTPException as e:
+            results[index].update({'status': 'error', 'code': e.status_code, 'detail': e.detail})
+
+    semaphores = {}
+
+    async def send(account, review_id, reply_text):
+        semaphore = semaphores.setdefault(account.business_id, asyncio.Semaphore(SEND_REPLIES_PER_BUSINESS))
+        async with semaphore:
+            try:
+                await send_marketplace_reply(account, review_id, reply_text)
+                return None
+            except HTTPException as e:
+                return e
+
+    errors = await asyncio.gather(*(send(account, review_id, reply_text)
+                                    for _, account, review_id, reply_text in prepared))
+
+    for (index, account, review_id, _), error in zip(prepared, errors):
+        if error:
+            results[index].update({'status': 'error', 'code': error.status_code, 'detail': error.detail})
         else:
+            await mark_review_replied(db, account, review_id)
+    await db.commit()
+
+    return {'results': results}
+
+# Отправка ответа в маркетплейс кабинета; при ошибке — HTTPException
+async def send_marketplace_reply(account: MarketplaceAccount, review_id: int, reply_text: str):
+    if account.marketplace == 'Яндекс.Маркет':
+        success = await send_reply_to_yandex_market(account, review_id, reply_text)
+        if not success:
             raise HTTPException(status_code=500, detail='Failed to send reply to Yandex Market')
     else:
         raise HTTPException(status_code=400, detail='Marketplace not supported yet')
 
-# Функция отправки ответа
-def send_reply_to_yandex_market(account: MarketplaceAccount, review_id: int, reply_text: str) -> bool:
-    token = account.api_key
-    headers = {
-        'Authorization': f'Bearer {token}',
-        'Content-Type': 'application/json'
-    }
+# Убираем отзыв из локальной очереди (commit — на вызывающей стороне)
+async def mark_review_replied(db: AsyncSession, account: MarketplaceAccount, review_id: int):
+    await db.execute(update(Review).where(
+        Review.business_id == account.business_id,
+        Review.feedback_id == review_id
+    ).values(reaction_status='REPLIED').execution_options(synchronize_session=False))
 
+# Функция отправки ответа
+async def send_reply_to_yandex_market(account: MarketplaceAccount, review_id: int, reply_text: str) -> bool:
     # Используем businessId из аккаунта
     business_id = account.business_id
     if not business_id:
         print("Error: No business_id found for this account")
         return False
 
-    # Новый URL по актуальной документации
-    url = f'https://api.partner.market.yandex.ru/businesses/{business_id}/goods-feedback/comments/update'
-
-    data = {
-        "feedbackId": review_id,
-        "comment": {
-            # id не указываем или ставим 0 для создания нового комментария
-#             "id": 0,
-#             "parentId": 0,
-            "text": reply_text
-        }
-    }
-
-    response = requests.post(url, headers=headers, json=data)
-    if response.status_code == 200:
+    response = await yandex_client.update_feedback_comment(account.api_key, business_id, review_id, reply_text)
+    if response.ok:
         return True
     else:
-        print(f"Error sending reply to Yandex Market: {response.status_code}, {response.text}")
+        print(f"Error sending reply to Yandex Market: {response.status}, {response.text}")
         return False
-
-
-
-
@@ -0,0 +1,83 @@
+# ReviewReplier
+# media_registry.py
+import os
+import json
+import hashlib
+from typing import Optional
+
+from aiogram.utils.exceptions import BadRequest
+
+
+class MediaRegistry:
+    """
+    Telegram file_id статических файлов бота (картинки и т. п.).
+    Файл загружается в Telegram один раз, дальше отправляется по file_id.
+    Ключ — хэш содержимого, поэтому изменённый файл загрузится заново.
+    Реестр хранится в JSON-файле и переживает перезапуск бота.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file_ids = self._load()
+        self._keys = {}
+        self.uploads = 0
+        self.reused = 0
+
+    def _load(self) -> dict:
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Пишем во временный файл и подменяем, чтобы не оставить реестр недописанным
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self._file_ids, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def _asset_key(self, asset_path: str) -> str:
+        key = self._keys.get(asset_path)
+        if key is None:
+            with open(asset_path, 'rb') as f:
+                digest = hashlib.sha256(f.read()).hexdigest()[:16]
+            key = self._keys[asset_path] = f"{os.path.basename(asset_path)}:{digest}"
+        return key
+
+    def get_file_id(self, asset_path: str) -> Optional[str]:
+        return self._file_ids.get(self._asset_key(asset_path))
+
+    async def send(self, send_method, asset_path: str, kind: str = 'photo', **kwargs):
+        """
+        send_method — например, message.answer_photo или bot.send_photo с chat_id в kwargs.
+        Если Telegram не принял сохранённый file_id, файл загружается заново.
+        """
+        key = self._asset_key(asset_path)
+        file_id = self._file_ids.get(key)
+        if file_id:
+            try:
+                message = await send_method(file_id, **kwargs)
+                self.reused += 1
+                return message
+            except BadRequest as e:
+                # Остальные ошибки (разметка, права) повторная загрузка не исправит
+                if 'file' not in str(e).lower():
+                    raise
+                self._file_ids.pop(key, None)
+
+        with open(asset_path, 'rb') as f:
+            message = await send_method(f, **kwargs)
+        self.uploads += 1
+        media = getattr(message, kind, None)
+        if media:
+            # У фото — список размеров, последний самый большой
+            self._file_ids[key] = media[-1].file_id if isinstance(media, list) else media.file_id
+            try:
+                self._save()
+            except OSError as e:
+                print(f"Failed to save media registry {self.path}: {e}")
+        return message
@@ -0,0 +1,63 @@
+# ReviewReplier
+# query_counter.py
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+from sqlalchemy import event
+
+# Счётчик запросов текущего контекста (запроса к API или блока count_queries)
+_current: ContextVar = ContextVar('query_counter', default=None)
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+        self.statements = []
+
+    def check(self, limit: int, label: Optional[str] = None):
+        if self.count > limit:
+            statements = '\n'.join(f"  {statement.strip()}" for statement in self.statements)
+            raise QueryBudgetExceeded(f"{label or 'block'}: {self.count} queries, budget {limit}\n{statements}")
+
+
+def track_queries(engine):
+    """
+    Подключает подсчёт SQL-запросов к движку (синхронному или AsyncEngine).
+    Считаются только запросы внутри count_queries(); служебные запросы
+    помечаются execution_options(skip_query_count=True) и не считаются.
+    """
+    sync_engine = getattr(engine, 'sync_engine', engine)
+
+    @event.listens_for(sync_engine, 'before_cursor_execute')
+    def count_query(conn, cursor, statement, parameters, context, executemany):
+        counter = _current.get()
+        if counter is None or context is not None and context.execution_options.get('skip_query_count'):
+            return
+        counter.count += 1
+        counter.statements.append(statement)
+
+
+@contextmanager
+def count_queries():
+    counter = QueryCounter()
+    token = _current.set(counter)
+    try:
+        yield counter
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def uncounted():
+    # Для фоновых задач, запущенных из запроса: они наследуют его контекст
+    token = _current.set(None)
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
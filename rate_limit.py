@@ -0,0 +1,197 @@
+# ReviewReplier
+# rate_limit.py
+import asyncio
+import time
+from typing import Optional
+
+
+class TokenBucket:
+    """
+    Асинхронный token bucket: rate токенов в секунду, не больше capacity в запасе.
+    Ожидающие обслуживаются по очереди (FIFO), чтобы крупные запросы не голодали.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        # Lock создаём лениво: он должен принадлежать работающему циклу
+        self._lock: Optional[asyncio.Lock] = None
+
+    @classmethod
+    def per_minute(cls, limit: float) -> 'TokenBucket':
+        return cls(rate=limit / 60.0, capacity=limit)
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, amount: float = 1.0) -> bool:
+        self._refill()
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return True
+        return False
+
+    def delay(self, amount: float = 1.0) -> float:
+        """
+        Сколько секунд ждать, пока наберётся amount токенов.
+        """
+        self._refill()
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    async def acquire(self, amount: float = 1.0):
+        # Запрос больше ёмкости иначе не выполнится никогда
+        amount = min(amount, self.capacity)
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            while not self.try_acquire(amount):
+                await asyncio.sleep(self.delay(amount))
+
+    def adjust(self, amount: float):
+        """
+        Возвращает (amount > 0) или дополнительно списывает (amount < 0) токены,
+        когда реальный расход стал известен после запроса.
+        """
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class LocalRateLimiter:
+    """
+    Лимиты по ключам в памяти процесса (на каждый ключ — свой TokenBucket).
+    """
+
+    def __init__(self):
+        self._buckets = {}
+
+    async def acquire(self, key: str, rate: float, capacity: float, max_wait: float) -> bool:
+        """
+        Ждёт токен не дольше max_wait секунд; False — лимит исчерпан.
+        """
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(rate=rate, capacity=capacity)
+        delay = bucket.delay()
+        if delay > max_wait:
+            return False
+        await bucket.acquire()
+        return True
+
+
+class PostgresRateLimiter:
+    """
+    Token bucket в таблице api_rate_limits: состояние общее для всех
+    процессов uvicorn. Списание токена — один атомарный UPSERT.
+    session_factory — фабрика асинхронных сессий SQLAlchemy.
+    """
+
+    ACQUIRE_SQL = """
+        INSERT INTO api_rate_limits (key, tokens, updated_at)
+        VALUES (:key, :capacity - 1, clock_timestamp())
+        ON CONFLICT (key) DO UPDATE SET
+            tokens = LEAST(:capacity, api_rate_limits.tokens
+                     + EXTRACT(EPOCH FROM clock_timestamp() - api_rate_limits.updated_at) * :rate) - 1,
+            updated_at = clock_timestamp()
+        WHERE LEAST(:capacity, api_rate_limits.tokens
+              + EXTRACT(EPOCH FROM clock_timestamp() - api_rate_limits.updated_at) * :rate) >= 1
+        RETURNING tokens
+    """
+
+    AVAILABLE_SQL = """
+        SELECT LEAST(:capacity, tokens + EXTRACT(EPOCH FROM clock_timestamp() - updated_at) * :rate)
+        FROM api_rate_limits WHERE key = :key
+    """
+
+    def __init__(self, session_factory, poll_interval: float = 5.0):
+        self.session_factory = session_factory
+        self.poll_interval = poll_interval
+
+    async def _try_acquire(self, key: str, rate: float, capacity: float) -> float:
+        """
+        0 — токен списан, иначе сколько секунд ждать следующего.
+        """
+        from sqlalchemy import text
+
+        params = {'key': key, 'rate': rate, 'capacity': capacity}
+        # Служебные запросы не входят в бюджеты запросов эндпоинтов (см. query_counter.py)
+        options = {'skip_query_count': True}
+        async with self.session_factory() as db:
+            acquired = (await db.execute(text(self.ACQUIRE_SQL), params, execution_options=options)).first()
+            if acquired is not None:
+                await db.commit()
+                return 0.0
+            available = (await db.execute(text(self.AVAILABLE_SQL), params,
+                                          execution_options=options)).scalar() or 0.0
+            await db.rollback()
+            return max((1 - float(available)) / rate, 0.01)
+
+    async def acquire(self, key: str, rate: float, capacity: float, max_wait: float) -> bool:
+        waited = 0.0
+        while True:
+            try:
+                delay = await self._try_acquire(key, rate, capacity)
+            except Exception as e:
+                # Недоступность БД не должна останавливать работу с API: квоту проверит сам Маркет
+                print(f"Rate limiter error for {key}: {e}")
+                return True
+            if delay == 0:
+                return True
+            if waited + delay > max_wait:
+                return False
+            # Другие процессы тоже тратят токены, поэтому перепроверяем не реже poll_interval
+            sleep = min(delay, self.poll_interval)
+            await asyncio.sleep(sleep)
+            waited += sleep
+
+
+class CircuitBreaker:
+    """
+    После failure_threshold ошибок подряд запросы отклоняются сразу
+    в течение reset_timeout секунд; затем пропускается один пробный запрос
+    (half-open), и по его результату цепь закрывается или открывается снова.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial_in_progress = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == 'closed':
+            return True
+        if state == 'half-open' and not self.trial_in_progress:
+            self.trial_in_progress = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_progress = False
+
+    def release_trial(self):
+        # Пробный запрос завершился без результата (отменён): следующий вызов попробует снова
+        self.trial_in_progress = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.trial_in_progress or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+        self.trial_in_progress = False
@@ -0,0 +1,113 @@
+# ReviewReplier
+# reply_cache.py
+import hashlib
+import json
+import re
+from typing import List, Optional
+
+from ttl_cache import TTLCache
+
+# Поля short_data, которые попадают в промпт (автор не входит в ключ)
+REPLY_KEY_FIELDS = ('advantages', 'disadvantages', 'comment', 'product_name', 'seller_name')
+
+# Имя автора в сохранённом ответе заменяется на метку и подставляется при выдаче
+AUTHOR_PLACEHOLDER = '{{author}}'
+# Более короткие имена ("Ян", "Ли") легко спутать с обычными словами ответа — такие ответы не кэшируем
+MIN_AUTHOR_LENGTH = 3
+
+
+def normalize_text(value) -> str:
+    """
+    "  Отлично!!! " и "отлично" дают одинаковый результат.
+    """
+    if not value:
+        return ''
+    text = str(value).lower().replace('ё', 'е')
+    text = re.sub(r'[^\w\s]', ' ', text)
+    return ' '.join(text.split())
+
+
+def reply_cache_key(short_data: dict) -> str:
+    normalized = {name: normalize_text(short_data.get(name)) for name in REPLY_KEY_FIELDS}
+    payload = json.dumps(normalized, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def author_stems(author: str) -> List[str]:
+    """
+    Основы слов имени автора ("Иван П." -> ["ива"]), чтобы найти в ответе
+    часть имени или его форму ("Ивану"). Слова короче MIN_AUTHOR_LENGTH не учитываются.
+    """
+    stems = []
+    for token in re.findall(r'\w+', author.lower()):
+        if len(token) >= MIN_AUTHOR_LENGTH:
+            stems.append(token[:-1] if len(token) > MIN_AUTHOR_LENGTH else token)
+    return stems
+
+
+def to_template(reply: str, author: Optional[str]) -> Optional[str]:
+    """
+    Ответ с меткой вместо имени автора или None, если ответ кэшировать нельзя.
+    Заменяются только целые слова: для автора "Ян" слово "Яндекс" не трогаем.
+    Если после замены в ответе осталась часть имени или его форма
+    ("Иван" при авторе "Иван П.", "Ольге" при авторе "Ольга"), ответ не кэшируем:
+    иначе его получит другой покупатель.
+    """
+    author = (author or '').strip()
+    if not author:
+        return reply
+    if len(author) < MIN_AUTHOR_LENGTH:
+        return None
+    template = re.sub(r'(?<!\w)' + re.escape(author) + r'(?!\w)', lambda match: AUTHOR_PLACEHOLDER, reply)
+    rest = template.replace(AUTHOR_PLACEHOLDER, ' ').lower()
+    for stem in author_stems(author):
+        if re.search(r'(?<!\w)' + re.escape(stem), rest):
+            return None
+    return template
+
+
+def render_template(template: str, author: Optional[str]) -> str:
+    if AUTHOR_PLACEHOLDER not in template:
+        return template
+    if author:
+        return template.replace(AUTHOR_PLACEHOLDER, author)
+    # Автора нет: убираем обращение вместе с запятой перед ним ("Спасибо, {{author}}!")
+    return re.sub(r',?\s*' + re.escape(AUTHOR_PLACEHOLDER), '', template)
+
+
+class ReplyPoolCache:
+    """
+    Пул вариантов ответа на одинаковые отзывы.
+    Пока в пуле меньше pool_size вариантов, нужен новый ответ от LLM;
+    после этого варианты выдаются по кругу, чтобы одинаковые отзывы
+    не получали один и тот же текст.
+    """
+
+    def __init__(self, pool_size: int = 3, maxsize: int = 4096, ttl: float = 3600):
+        self.pool_size = pool_size
+        self._pools = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def get_pool(self, key: str) -> Optional[dict]:
+        return self._pools.get(key)
+
+    def set_pool(self, key: str, templates: List[str]):
+        self._pools.set(key, {'templates': list(templates[-self.pool_size:]), 'next': 0})
+
+    def is_full(self, pool: Optional[dict]) -> bool:
+        return pool is not None and len(pool['templates']) >= self.pool_size
+
+    def next_template(self, pool: dict) -> str:
+        templates = pool['templates']
+        template = templates[pool['next'] % len(templates)]
+        pool['next'] += 1
+        return template
+
+    def add(self, key: str, template: str):
+        pool = self._pools.get(key)
+        if pool is None:
+            self.set_pool(key, [template])
+        elif template not in pool['templates']:
+            pool['templates'] = (pool['templates'] + [template])[-self.pool_size:]
+
+    def stats(self) -> dict:
+        return self._pools.stats()
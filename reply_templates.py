@@ -0,0 +1,72 @@
+# ReviewReplier
+# reply_templates.py
+import random
+import re
+from typing import List, Optional
+
+# Отзывы без текста с оценкой не ниже этой обрабатываются шаблонами, без LLM
+TEMPLATE_MIN_RATING = 4
+
+# Неизвестный автор в ответе не упоминается
+UNKNOWN_AUTHORS = ('', 'Неизвестно', 'Неизвестный автор')
+
+# Шаблоны по умолчанию, если у компании нет своих: (min_rating, max_rating, text)
+DEFAULT_TEMPLATES = [
+    (4, 5, "Здравствуйте, {author}! Спасибо за высокую оценку. Будем рады видеть вас снова в магазине {seller}!"),
+    (4, 5, "{author}, благодарим за отзыв! Рады, что покупка вас порадовала. Ваш {seller}."),
+    (5, 5, "Здравствуйте, {author}! Спасибо за пять звёзд для товара «{product}». Приятных покупок!"),
+    (5, 5, "{author}, спасибо за отличную оценку! Нам очень приятно, что вы выбрали {seller}."),
+    (4, 4, "Здравствуйте, {author}! Спасибо за хорошую оценку товара «{product}». Будем рады, если расскажете, что можно улучшить."),
+]
+
+
+def parse_rating(value) -> Optional[int]:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def is_trivial_review(short_data: dict) -> bool:
+    """
+    Отзыв без плюсов, минусов и комментария с высокой оценкой — LLM ему не нужна.
+    """
+    if any((short_data.get(name) or '').strip() for name in ('advantages', 'disadvantages', 'comment')):
+        return False
+    rating = parse_rating(short_data.get('rating'))
+    return rating is not None and rating >= TEMPLATE_MIN_RATING
+
+
+def fill_template(text: str, short_data: dict) -> str:
+    author = (short_data.get('author') or '').strip()
+    if author in UNKNOWN_AUTHORS:
+        # "Здравствуйте, {author}!" -> "Здравствуйте!", "{author}, спасибо" -> "Спасибо"
+        text = re.sub(r',\s*\{author\}', '', text)
+        text = re.sub(r'^\{author\},\s*(\w)', lambda m: m.group(1).upper(), text)
+        text = text.replace('{author}', '')
+    else:
+        text = text.replace('{author}', author)
+    text = text.replace('{product}', short_data.get('product_name') or '')
+    text = text.replace('{seller}', short_data.get('seller_name') or '')
+    return ' '.join(text.split())
+
+
+def pick_template(templates: List[tuple], short_data: dict) -> Optional[str]:
+    """
+    templates — список (min_rating, max_rating, product_name, text).
+    Шаблоны конкретного товара важнее общих; шаблоны с {product}
+    не используются, если товар неизвестен. Среди подходящих выбираем случайно,
+    чтобы одинаковые отзывы не получали один и тот же текст.
+    """
+    rating = parse_rating(short_data.get('rating'))
+    product_name = short_data.get('product_name')
+    matching = [
+        (product, text) for min_rating, max_rating, product, text in templates
+        if (min_rating or 0) <= rating <= (max_rating or 5)
+        and (product is None or product == product_name)
+        and (product_name or '{product}' not in text)
+    ]
+    if not matching:
+        return None
+    specific = [text for product, text in matching if product is not None]
+    return fill_template(random.choice(specific or [text for _, text in matching]), short_data)
@@ -0,0 +1,219 @@
+# ReviewReplier
+# send_scheduler.py
+import asyncio
+import heapq
+import itertools
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+from aiogram import Bot
+from aiogram.utils.exceptions import RetryAfter
+
+from rate_limit import TokenBucket
+
+# Полосы приоритета: меньше — раньше
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 10
+LANES = {PRIORITY_INTERACTIVE: 'interactive', PRIORITY_BACKGROUND: 'background'}
+
+# Приоритет отправок текущей задачи; фоновые рассылки оборачиваются в background_sends()
+send_priority: ContextVar = ContextVar('send_priority', default=PRIORITY_INTERACTIVE)
+
+# Методы Bot API, на которые действуют лимиты Telegram на сообщения
+THROTTLED_METHODS = {
+    'sendMessage', 'sendPhoto', 'sendMediaGroup', 'sendDocument', 'sendVideo', 'sendAnimation',
+    'sendAudio', 'sendVoice', 'sendSticker', 'copyMessage', 'forwardMessage',
+    'editMessageText', 'editMessageCaption', 'editMessageMedia', 'editMessageReplyMarkup',
+}
+
+
+@contextmanager
+def background_sends():
+    token = send_priority.set(PRIORITY_BACKGROUND)
+    try:
+        yield
+    finally:
+        send_priority.reset(token)
+
+
+class SendScheduler:
+    """
+    Общая очередь исходящих сообщений Telegram.
+    Сообщения одного чата уходят по порядку и не чаще chat_rate в секунду
+    (с запасом chat_burst), все вместе — не чаще global_rate в секунду.
+    Глобальные слоты выдаются по приоритету: ответы пользователю раньше фоновых
+    уведомлений. На RetryAfter ждём указанное Telegram время и повторяем.
+    """
+
+    def __init__(self, global_rate: float = 30.0, chat_rate: float = 1.0, chat_burst: float = 3.0,
+                 max_retries: int = 3, max_retry_after: float = 60.0, max_chats: int = 10000,
+                 chat_idle_ttl: float = 600.0):
+        self.global_bucket = TokenBucket(rate=global_rate, capacity=global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.max_retry_after = max_retry_after
+        # Состояние чатов (порядок — от давно не использованных к недавним). Вытесняются
+        # только чаты, в которых сейчас ничего не отправляется и никто не ждёт блокировку
+        self.max_chats = max_chats
+        self.chat_idle_ttl = chat_idle_ttl
+        self._chats: "OrderedDict[object, dict]" = OrderedDict()
+        self._heap = []
+        self._seq = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+        self.counters = {'sent': 0, 'retry_after': 0, 'failed': 0}
+        self.waiting = {name: 0 for name in LANES.values()}
+        self.wait_total = {name: 0.0 for name in LANES.values()}
+        self.wait_max = {name: 0.0 for name in LANES.values()}
+        self.wait_count = {name: 0 for name in LANES.values()}
+
+    def _acquire_chat(self, chat_id) -> dict:
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            if len(self._chats) >= self.max_chats:
+                self._evict_idle_chats()
+            chat = {'lock': asyncio.Lock(), 'bucket': TokenBucket(rate=self.chat_rate, capacity=self.chat_burst),
+                    'users': 0, 'used': 0.0}
+            self._chats[chat_id] = chat
+        self._chats.move_to_end(chat_id)
+        chat['users'] += 1
+        chat['used'] = time.monotonic()
+        return chat
+
+    def _release_chat(self, chat: dict):
+        chat['users'] -= 1
+        chat['used'] = time.monotonic()
+
+    def _evict_idle_chats(self):
+        # Сначала простаивающие дольше chat_idle_ttl, затем, если места всё ещё нет, — самые давние
+        now = time.monotonic()
+        idle = [chat_id for chat_id, chat in self._chats.items() if chat['users'] == 0]
+        for chat_id in idle:
+            if now - self._chats[chat_id]['used'] > self.chat_idle_ttl:
+                del self._chats[chat_id]
+        for chat_id in idle:
+            if len(self._chats) < self.max_chats:
+                break
+            self._chats.pop(chat_id, None)
+
+    def _ensure_dispatcher(self):
+        # Задачу и Event создаём лениво: они должны принадлежать работающему циклу
+        if self._dispatcher is None or self._dispatcher.done():
+            self._wakeup = asyncio.Event()
+            self._dispatcher = asyncio.ensure_future(self._dispatch())
+
+    async def _dispatch(self):
+        while True:
+            while not self._heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            await self.global_bucket.acquire()
+            # Пока ждали токен, мог прийти более срочный запрос — берём верх кучи сейчас
+            while self._heap:
+                _, _, turn = heapq.heappop(self._heap)
+                if not turn.done():
+                    turn.set_result(None)
+                    break
+            else:
+                # Все ожидавшие отменены: токен не потрачен
+                self.global_bucket.adjust(1)
+
+    async def _global_turn(self, priority: int):
+        self._ensure_dispatcher()
+        turn = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._heap, (priority, next(self._seq), turn))
+        self._wakeup.set()
+        await turn
+
+    async def run(self, chat_id, call, priority: Optional[int] = None, retryable: bool = True):
+        """
+        Выполняет call() (корутину запроса к Bot API) с соблюдением лимитов.
+        retryable=False — не повторять на RetryAfter (например, загрузка файла).
+        """
+        priority = send_priority.get() if priority is None else priority
+        lane = LANES.get(priority, 'background')
+        chat = self._acquire_chat(chat_id) if chat_id is not None else None
+        queued_at = time.monotonic()
+        waiting = True
+        self.waiting[lane] += 1
+        try:
+            if chat is not None:
+                await chat['lock'].acquire()
+            try:
+                for attempt in range(self.max_retries + 1):
+                    if chat is not None:
+                        await chat['bucket'].acquire()
+                    await self._global_turn(priority)
+                    if waiting:
+                        waiting = False
+                        self.waiting[lane] -= 1
+                        self._record_wait(lane, time.monotonic() - queued_at)
+                    try:
+                        result = await call()
+                        self.counters['sent'] += 1
+                        return result
+                    except RetryAfter as e:
+                        self.counters['retry_after'] += 1
+                        if not retryable or attempt == self.max_retries or e.timeout > self.max_retry_after:
+                            self.counters['failed'] += 1
+                            raise
+                        # Держим блокировку чата: следующие его сообщения ждут вместе с этим
+                        await asyncio.sleep(e.timeout)
+            finally:
+                if chat is not None:
+                    chat['lock'].release()
+        finally:
+            if waiting:
+                # Вызов отменён, не дождавшись очереди
+                self.waiting[lane] -= 1
+            if chat is not None:
+                self._release_chat(chat)
+
+    def _record_wait(self, lane: str, wait: float):
+        self.wait_count[lane] += 1
+        self.wait_total[lane] += wait
+        self.wait_max[lane] = max(self.wait_max[lane], wait)
+
+    def stats(self) -> dict:
+        return {
+            **self.counters,
+            'global_queue': len(self._heap),
+            'chats': len(self._chats),
+            'lanes': {
+                lane: {
+                    'waiting': self.waiting[lane],
+                    'sent': self.wait_count[lane],
+                    'avg_wait': round(self.wait_total[lane] / self.wait_count[lane], 3)
+                    if self.wait_count[lane] else None,
+                    'max_wait': round(self.wait_max[lane], 3),
+                } for lane in LANES.values()
+            },
+        }
+
+
+class ScheduledBot(Bot):
+    """
+    Bot, у которого все отправки и правки сообщений проходят через SendScheduler.
+    Обработчики продолжают вызывать message.answer(), bot.send_message() и т. п.
+    """
+
+    def __init__(self, *args, scheduler: SendScheduler, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.scheduler = scheduler
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        if method not in THROTTLED_METHODS:
+            return await super().request(method, data, files, **kwargs)
+
+        parent = super()
+
+        async def call():
+            return await parent.request(method, data, files, **kwargs)
+
+        chat_id = (data or {}).get('chat_id')
+        # Файл при повторе уже прочитан, поэтому загрузки не повторяем
+        return await self.scheduler.run(chat_id, call, retryable=not files)
@@ -0,0 +1,82 @@
+# ReviewReplier
+# singleflight.py
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+
+class SingleFlight:
+    """
+    Объединяет одновременные одинаковые вызовы к внешним API:
+    пока запрос с ключом key выполняется, остальные вызывающие ждут
+    его результат вместо того, чтобы отправлять свой.
+    """
+
+    def __init__(self):
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        self.calls = 0      # реально выполненные вызовы
+        self.shared = 0     # вызовы, присоединившиеся к уже идущему запросу
+        self.memoized = 0   # повторы внутри одного запроса (см. RequestScope)
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        fut = self._inflight.get(key)
+        if fut is None:
+            self.calls += 1
+            fut = asyncio.ensure_future(fn())
+            fut.waiters = 0
+            self._inflight[key] = fut
+
+            def _forget(f, key=key):
+                if self._inflight.get(key) is f:
+                    del self._inflight[key]
+            fut.add_done_callback(_forget)
+        else:
+            self.shared += 1
+
+        fut.waiters += 1
+        try:
+            # shield: отмена одного ожидающего не должна отменять общий запрос
+            return await asyncio.shield(fut)
+        except asyncio.CancelledError:
+            # ...но если его больше никто не ждёт, запрос можно прервать
+            if fut.waiters == 1 and not fut.done():
+                fut.cancel()
+                # Задача станет done только на следующей итерации цикла: убираем её сразу,
+                # чтобы новый вызывающий не присоединился к отменённому запросу
+                if self._inflight.get(key) is fut:
+                    del self._inflight[key]
+            raise
+        finally:
+            fut.waiters -= 1
+
+    def stats(self) -> dict:
+        return {
+            'calls': self.calls,
+            'shared_inflight': self.shared,
+            'memoized': self.memoized,
+            'saved': self.shared + self.memoized,
+            'inflight': len(self._inflight),
+        }
+
+
+class RequestScope:
+    """
+    Мемоизация на время одного HTTP-запроса: одинаковые вызовы внутри
+    запроса выполняются один раз, а одновременные запросы с одинаковыми
+    ключами разделяют общий результат через SingleFlight.
+    """
+
+    def __init__(self, flight: SingleFlight):
+        self.flight = flight
+        self._results: Dict[Hashable, Any] = {}
+
+    async def call(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        if key in self._results:
+            self.flight.memoized += 1
+            return self._results[key]
+        result = await self.flight.do(key, fn)
+        self._results[key] = result
+        return result
+
+
+# Общий single-flight для вызовов Яндекс.Маркета
+upstream_flight = SingleFlight()
@@ -0,0 +1,22 @@
+# ReviewReplier
+# tests/test_reply_cache.py
+from reply_cache import render_template, to_template
+
+
+def test_full_author_is_replaced():
+    template = to_template("Иван, спасибо за отзыв!", "Иван")
+    assert template == "{{author}}, спасибо за отзыв!"
+    assert render_template(template, "Ольга") == "Ольга, спасибо за отзыв!"
+
+
+def test_author_inside_word_is_kept():
+    assert to_template("Ян, спасибо! Ждём вас на Яндекс Маркете.", "Ян") is None
+    assert to_template("Спасибо за отзыв на Яндекс Маркете!", "Яна") == "Спасибо за отзыв на Яндекс Маркете!"
+
+
+def test_partial_name_is_not_cached():
+    assert to_template("Иван, спасибо за отзыв о нашем товаре!", "Иван П.") is None
+
+
+def test_inflected_name_is_not_cached():
+    assert to_template("Ольга, спасибо! Ольге мы отправим промокод.", "Ольга") is None
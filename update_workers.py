@@ -0,0 +1,239 @@
+# ReviewReplier
+# update_workers.py
+import asyncio
+import glob
+import json
+import os
+import time
+import uuid
+from contextlib import asynccontextmanager
+from typing import List, Optional
+
+import asyncpg
+from aiogram import Bot, Dispatcher, types
+
+# Поля Update, по которым определяется пользователь (в порядке проверки)
+UPDATE_FIELDS = (
+    'message', 'edited_message', 'callback_query', 'inline_query', 'chosen_inline_result',
+    'shipping_query', 'pre_checkout_query', 'poll_answer', 'my_chat_member', 'chat_member',
+    'chat_join_request', 'channel_post', 'edited_channel_post',
+)
+
+
+def update_user_key(update: types.Update) -> int:
+    """
+    Пользователь (или чат), к которому относится апдейт.
+    Апдейты без пользователя раскладываются по update_id.
+    """
+    for name in UPDATE_FIELDS:
+        obj = getattr(update, name, None)
+        if obj is None:
+            continue
+        user = getattr(obj, 'from_user', None) or getattr(obj, 'user', None)
+        if user is not None:
+            return user.id
+        chat = getattr(obj, 'chat', None)
+        if chat is not None:
+            return chat.id
+    return update.update_id
+
+
+class AdvisoryUserLock:
+    """
+    Взаимное исключение обработки апдейтов одного пользователя между репликами:
+    на время обработки берётся pg_advisory_xact_lock по ключу пользователя.
+    Без него балансировщик может отдать два апдейта пользователя разным репликам,
+    и они будут обработаны одновременно. Каждый воркер держит не больше одного
+    соединения, поэтому pool_size — по числу воркеров.
+    """
+
+    def __init__(self, dsn: str, pool_size: int = 16):
+        self.dsn = dsn
+        self.pool_size = pool_size
+        self._pool: Optional[asyncpg.Pool] = None
+        # Lock создаём лениво: он должен принадлежать работающему циклу
+        self._pool_lock: Optional[asyncio.Lock] = None
+
+    async def _get_pool(self) -> asyncpg.Pool:
+        if self._pool is None:
+            if self._pool_lock is None:
+                self._pool_lock = asyncio.Lock()
+            async with self._pool_lock:
+                if self._pool is None:
+                    self._pool = await asyncpg.create_pool(self.dsn, min_size=1, max_size=self.pool_size)
+        return self._pool
+
+    @asynccontextmanager
+    async def hold(self, key: int):
+        pool = conn = None
+        try:
+            pool = await self._get_pool()
+            conn = await pool.acquire()
+        except Exception as e:
+            # Недоступность БД не должна останавливать бота: обрабатываем без блокировки
+            print(f"User lock unavailable for {key}: {e}")
+        if conn is None:
+            yield
+            return
+        try:
+            # Блокировка транзакционная: снимется сама при любом завершении транзакции
+            async with conn.transaction():
+                await conn.execute('SELECT pg_advisory_xact_lock($1)', key)
+                yield
+        finally:
+            await pool.release(conn)
+
+    async def close(self):
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+
+
+class UpdateWorkerPool:
+    """
+    Ограниченный пул обработчиков апдейтов.
+    Апдейты одного пользователя всегда попадают к одному воркеру и
+    обрабатываются по порядку; разные пользователи — параллельно.
+    Очередь каждого воркера ограничена queue_size: при переполнении submit
+    ждёт, и Telegram повторит доставку, а не потеряет апдейт.
+
+    Порядок гарантируется только внутри процесса. Если реплик несколько,
+    нужен user_lock (AdvisoryUserLock): апдейты одного пользователя на разных
+    репликах тогда хотя бы не обрабатываются одновременно.
+
+    При остановке новые апдейты не принимаются (submit возвращает False, и
+    webhook отвечает ошибкой, чтобы Telegram доставил их повторно), принятые
+    дообрабатываются, а не успевшие — сохраняются в backlog_dir и
+    обрабатываются при следующем запуске (restore).
+    """
+
+    def __init__(self, dispatcher: Dispatcher, workers: int = 16, queue_size: int = 100,
+                 user_lock: Optional[AdvisoryUserLock] = None, backlog_dir: Optional[str] = None):
+        self.dispatcher = dispatcher
+        self.workers = workers
+        self.queue_size = queue_size
+        self.user_lock = user_lock
+        self.backlog_dir = backlog_dir
+        self._queues: List[asyncio.Queue] = []
+        self._tasks: List[asyncio.Task] = []
+        self._closing = False
+        self._stopped = False
+        self.counters = {'submitted': 0, 'processed': 0, 'failed': 0, 'rejected': 0, 'saved': 0, 'restored': 0}
+        self.max_wait = 0.0
+
+    def start(self):
+        # Очереди создаём при старте: они должны принадлежать работающему циклу
+        self._queues = [asyncio.Queue(maxsize=self.queue_size) for _ in range(self.workers)]
+        self._tasks = [asyncio.ensure_future(self._worker(queue)) for queue in self._queues]
+        self._closing = self._stopped = False
+
+    async def submit(self, update: types.Update) -> bool:
+        """
+        False — апдейт не принят (пул останавливается), его нужно доставить повторно.
+        """
+        if self._closing:
+            self.counters['rejected'] += 1
+            return False
+        queue = self._queues[update_user_key(update) % self.workers]
+        await queue.put((time.monotonic(), update))
+        if self._stopped:
+            # Место в очереди освободилось уже после сохранения остатка: апдейт никто не обработает
+            self.counters['rejected'] += 1
+            return False
+        self.counters['submitted'] += 1
+        return True
+
+    async def _worker(self, queue: asyncio.Queue):
+        Dispatcher.set_current(self.dispatcher)
+        Bot.set_current(self.dispatcher.bot)
+        while True:
+            queued_at, update = await queue.get()
+            self.max_wait = max(self.max_wait, time.monotonic() - queued_at)
+            try:
+                if self.user_lock is not None:
+                    async with self.user_lock.hold(update_user_key(update)):
+                        await self.dispatcher.process_updates([update])
+                else:
+                    await self.dispatcher.process_updates([update])
+                self.counters['processed'] += 1
+            except Exception as e:
+                self.counters['failed'] += 1
+                print(f"Error processing update {update.update_id}: {e}")
+            finally:
+                queue.task_done()
+
+    async def stop(self, drain_timeout: Optional[float] = 25):
+        """
+        Перестаём принимать апдейты, дожидаемся принятых (не дольше drain_timeout),
+        останавливаем воркеры и сохраняем то, что не успели обработать.
+        """
+        self._closing = True
+        try:
+            await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in self._queues)), drain_timeout)
+        except asyncio.TimeoutError:
+            print(f"Update workers stopped with {self.queued()} updates not processed")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+        # Между разбором очередей и _stopped нет await: submit, ждавший места, увидит _stopped
+        remaining = []
+        for queue in self._queues:
+            while not queue.empty():
+                remaining.append(queue.get_nowait()[1])
+        self._stopped = True
+        if remaining:
+            self._save_backlog(remaining)
+        if self.user_lock is not None:
+            await self.user_lock.close()
+
+    def _save_backlog(self, updates: List[types.Update]):
+        if not self.backlog_dir:
+            print(f"Update workers dropped {len(updates)} unprocessed updates: "
+                  f"{[update.update_id for update in updates]}")
+            return
+        os.makedirs(self.backlog_dir, exist_ok=True)
+        # Своё имя у каждой реплики, чтобы общий каталог не перезаписывался
+        path = os.path.join(self.backlog_dir, f"updates-{uuid.uuid4().hex}.json")
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump([update.to_python() for update in updates], f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        self.counters['saved'] += len(updates)
+        print(f"Update workers saved {len(updates)} unprocessed updates to {path}")
+
+    async def restore(self):
+        """
+        Ставит в очередь апдейты, сохранённые при прошлой остановке (этой или другой реплики).
+        """
+        if not self.backlog_dir:
+            return
+        for path in sorted(glob.glob(os.path.join(self.backlog_dir, 'updates-*.json'))):
+            claimed = f"{path}.{uuid.uuid4().hex}.claimed"
+            try:
+                # Переименование атомарно: файл достанется одной реплике
+                os.replace(path, claimed)
+            except OSError:
+                continue
+            try:
+                with open(claimed, encoding='utf-8') as f:
+                    updates = [types.Update.to_object(data) for data in json.load(f)]
+            except (OSError, ValueError) as e:
+                print(f"Failed to read update backlog {claimed}: {e}")
+                continue
+            for update in updates:
+                await self.submit(update)
+            self.counters['restored'] += len(updates)
+            os.remove(claimed)
+
+    def queued(self) -> int:
+        return sum(queue.qsize() for queue in self._queues)
+
+    def stats(self) -> dict:
+        return {
+            **self.counters,
+            'workers': self.workers,
+            'queued': self.queued(),
+            'max_wait': round(self.max_wait, 3),
+        }
@@ -0,0 +1,357 @@
+# ReviewReplier
+# yandex_market.py
+import os
+import json
+import random
+import asyncio
+import hashlib
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+import aiohttp
+
+from rate_limit import CircuitBreaker, LocalRateLimiter
+
+API_URL = 'https://api.partner.market.yandex.ru'
+
+# Таймауты (в секундах) и размеры пула соединений
+YANDEX_TIMEOUT = float(os.getenv('YANDEX_TIMEOUT', '15'))
+YANDEX_CONNECT_TIMEOUT = float(os.getenv('YANDEX_CONNECT_TIMEOUT', '5'))
+YANDEX_POOL_SIZE = int(os.getenv('YANDEX_POOL_SIZE', '100'))
+YANDEX_KEEPALIVE = float(os.getenv('YANDEX_KEEPALIVE', '30'))
+
+# Квоты Partner API: метод -> (запросов, за секунд). Лимит действует отдельно
+# для каждого кабинета (бизнеса) или магазина (кампании). Переопределяются
+# через YANDEX_QUOTAS='{"goods_feedback": [500, 3600]}'.
+YANDEX_QUOTAS = {
+    'campaigns': (1000, 3600),
+    'goods_feedback': (1000, 3600),
+    'goods_feedback_comments_update': (1000, 3600),
+    'order': (100000, 3600),
+}
+YANDEX_QUOTAS.update({name: tuple(quota) for name, quota in json.loads(os.getenv('YANDEX_QUOTAS', '{}')).items()})
+
+# Сколько ждать токен лимита, прежде чем отказаться (локальный ответ 420)
+YANDEX_MAX_LIMIT_WAIT = float(os.getenv('YANDEX_MAX_LIMIT_WAIT', '10'))
+YANDEX_MAX_RETRIES = int(os.getenv('YANDEX_MAX_RETRIES', '3'))
+YANDEX_BACKOFF_BASE = float(os.getenv('YANDEX_BACKOFF_BASE', '1'))
+YANDEX_BACKOFF_MAX = float(os.getenv('YANDEX_BACKOFF_MAX', '30'))
+YANDEX_BREAKER_THRESHOLD = int(os.getenv('YANDEX_BREAKER_THRESHOLD', '5'))
+YANDEX_BREAKER_RESET = float(os.getenv('YANDEX_BREAKER_RESET', '30'))
+
+# 420 — превышена квота Маркета; эти статусы повторяем для любых методов:
+# запрос не был выполнен
+RETRY_STATUSES = (420, 429, 503)
+# Сетевые ошибки и 5xx повторяем только для идемпотентных методов
+RETRY_IDEMPOTENT_STATUSES = (500, 502, 504)
+
+
+@dataclass
+class YandexResponse:
+    """
+    Сырой ответ API: статус, разобранный JSON и текст (для сообщений об ошибках).
+    Сетевые ошибки и таймауты тоже превращаются в ответ (502/504), чтобы
+    вызывающий код обрабатывал их так же, как любой другой не-200 статус.
+    """
+    status: int
+    data: dict = field(default_factory=dict)
+    text: str = ''
+    retry_after: Optional[float] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.status == 200
+
+
+@dataclass
+class CampaignInfo:
+    id: int
+    domain: Optional[str]
+    name: Optional[str]
+    placement_type: Optional[str]
+    business_id: Optional[int]
+    business_name: Optional[str]
+
+
+@dataclass
+class CampaignsResult:
+    response: YandexResponse
+    campaigns: List[CampaignInfo] = field(default_factory=list)
+
+
+@dataclass
+class FeedbackPage:
+    response: YandexResponse
+    feedbacks: List[dict] = field(default_factory=list)
+    next_page_token: Optional[str] = None
+
+
+@dataclass
+class OrderItem:
+    offer_id: Optional[str]
+    offer_name: Optional[str]
+
+
+# Статусы, означающие, что заказа в кампании точно нет (или к ней нет доступа)
+ORDER_NOT_FOUND_STATUSES = (400, 403, 404)
+
+
+@dataclass
+class OrderResult:
+    response: YandexResponse
+    item: Optional[OrderItem] = None
+
+    @property
+    def not_found(self) -> bool:
+        """
+        True — окончательный ответ «заказа здесь нет», его можно кэшировать.
+        Сетевые ошибки, 5xx и превышение лимитов сюда не относятся.
+        """
+        if self.item is not None:
+            return False
+        return self.response.ok or self.response.status in ORDER_NOT_FOUND_STATUSES
+
+
+def api_key_scope(api_key: str) -> str:
+    # Квота списка кампаний — на пользователя; сам ключ в таблицу лимитов не пишем
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:16]
+
+
+class YandexMarketClient:
+    """
+    Асинхронный клиент Partner API Яндекс.Маркета.
+    Одна aiohttp-сессия на процесс: соединения переиспользуются (keep-alive),
+    а событийный цикл uvicorn не блокируется на время запроса.
+    Каждый метод API ограничен своей квотой (token bucket на кабинет или
+    магазин) и своим circuit breaker.
+    """
+
+    def __init__(self, base_url: str = API_URL, pool_size: int = YANDEX_POOL_SIZE,
+                 timeout: float = YANDEX_TIMEOUT, connect_timeout: float = YANDEX_CONNECT_TIMEOUT,
+                 keepalive: float = YANDEX_KEEPALIVE, quotas: dict = None, limiter=None,
+                 max_limit_wait: float = YANDEX_MAX_LIMIT_WAIT, max_retries: int = YANDEX_MAX_RETRIES,
+                 breaker_threshold: int = YANDEX_BREAKER_THRESHOLD, breaker_reset: float = YANDEX_BREAKER_RESET):
+        self.base_url = base_url
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.keepalive = keepalive
+        self.quotas = quotas or YANDEX_QUOTAS
+        # Любой объект с async acquire(key, rate, capacity, max_wait) -> bool;
+        # бэкенд подставляет общий для всех процессов PostgresRateLimiter
+        self.limiter = limiter or LocalRateLimiter()
+        self.max_limit_wait = max_limit_wait
+        self.max_retries = max_retries
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset = breaker_reset
+        # Цепь размыкается по методу API целиком: деградация Маркета не зависит от кабинета
+        self.breakers = {}
+        self.counters = {'requests': 0, 'retries': 0, 'limited': 0, 'breaker_rejected': 0}
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # Сессию создаём лениво: она должна принадлежать работающему циклу
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size,
+                keepalive_timeout=self.keepalive,
+                ttl_dns_cache=300,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout, connect=self.connect_timeout),
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def _send(self, method: str, path: str, api_key: str, params: dict = None,
+                    json: dict = None, timeout: float = None) -> YandexResponse:
+        headers = {
+            'Authorization': f'Bearer {api_key}',
+            'Content-Type': 'application/json'
+        }
+        kwargs = {}
+        if timeout is not None:
+            kwargs['timeout'] = aiohttp.ClientTimeout(total=timeout, connect=self.connect_timeout)
+
+        session = self._get_session()
+        try:
+            async with session.request(method, f"{self.base_url}{path}", headers=headers,
+                                       params=params, json=json, **kwargs) as resp:
+                text = await resp.text()
+                data = {}
+                if resp.status == 200:
+                    try:
+                        data = await resp.json(content_type=None)
+                    except ValueError:
+                        data = {}
+                retry_after = None
+                try:
+                    retry_after = float(resp.headers.get('Retry-After', ''))
+                except ValueError:
+                    pass
+                return YandexResponse(status=resp.status, data=data or {}, text=text, retry_after=retry_after)
+        except asyncio.TimeoutError:
+            return YandexResponse(status=504, text=f"Timeout: {method} {path}")
+        except aiohttp.ClientError as e:
+            return YandexResponse(status=502, text=f"{type(e).__name__}: {e}")
+
+    def _breaker(self, quota: str) -> CircuitBreaker:
+        breaker = self.breakers.get(quota)
+        if breaker is None:
+            breaker = self.breakers[quota] = CircuitBreaker(self.breaker_threshold, self.breaker_reset)
+        return breaker
+
+    @staticmethod
+    def _backoff(attempt: int, response: YandexResponse) -> float:
+        if response.retry_after is not None:
+            return response.retry_after
+        delay = min(YANDEX_BACKOFF_MAX, YANDEX_BACKOFF_BASE * 2 ** attempt)
+        return delay * random.uniform(0.5, 1.5)
+
+    async def _request(self, method: str, path: str, api_key: str, params: dict = None,
+                       json: dict = None, timeout: float = None, quota: str = None,
+                       scope=None, idempotent: bool = True) -> YandexResponse:
+        """
+        Запрос с учётом квоты метода quota для кабинета/магазина scope:
+        ждём токен лимита, повторяем 420/429/503 (и 5xx для идемпотентных
+        методов) с задержкой, а при серии ошибок Маркета сразу отвечаем 503.
+        """
+        if quota is None:
+            return await self._send(method, path, api_key, params=params, json=json, timeout=timeout)
+
+        limit, period = self.quotas[quota]
+        limit_key = f"yandex:{quota}:{scope}"
+        breaker = self._breaker(quota)
+        retry_statuses = RETRY_STATUSES + (RETRY_IDEMPOTENT_STATUSES if idempotent else ())
+        for attempt in range(self.max_retries + 1):
+            # Открытую цепь проверяем до лимита, чтобы не тратить токены
+            if breaker.state == 'open':
+                self.counters['breaker_rejected'] += 1
+                return YandexResponse(status=503, text=f"Circuit breaker open: {quota}")
+            if not await self.limiter.acquire(limit_key, limit / period, limit, self.max_limit_wait):
+                self.counters['limited'] += 1
+                return YandexResponse(status=420, text=f"Rate limit exceeded: {quota} ({scope})")
+            if not breaker.allow():
+                # Пробный запрос half-open уже выполняет другая корутина
+                self.counters['breaker_rejected'] += 1
+                return YandexResponse(status=503, text=f"Circuit breaker open: {quota}")
+
+            self.counters['requests'] += 1
+            try:
+                response = await self._send(method, path, api_key, params=params, json=json, timeout=timeout)
+            except BaseException:
+                # Запрос отменён (проигравшая проба заказа, никому не нужный single-flight):
+                # исход неизвестен, но пробный слот half-open нужно освободить
+                breaker.release_trial()
+                raise
+            # Отказы по квоте (420/429) — не признак деградации Маркета
+            if response.status >= 500:
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+
+            if response.status not in retry_statuses or attempt == self.max_retries:
+                return response
+            delay = self._backoff(attempt, response)
+            if delay > YANDEX_BACKOFF_MAX:
+                return response
+            self.counters['retries'] += 1
+            await asyncio.sleep(delay)
+
+    def stats(self) -> dict:
+        return {
+            **self.counters,
+            'breakers': {quota: breaker.state for quota, breaker in self.breakers.items()},
+        }
+
+    async def get_campaigns(self, api_key: str, page: int = 1, page_size: int = 50,
+                            timeout: float = None) -> CampaignsResult:
+        """
+        GET /campaigns — список кампаний, доступных по API-ключу.
+        """
+        response = await self._request('GET', '/campaigns', api_key,
+                                       params={'page': page, 'pageSize': page_size}, timeout=timeout,
+                                       quota='campaigns', scope=api_key_scope(api_key))
+        if not response.ok:
+            return CampaignsResult(response=response)
+
+        campaigns = []
+        for camp in response.data.get('campaigns', []):
+            business = camp.get('business', {})
+            campaigns.append(CampaignInfo(
+                id=camp['id'],
+                domain=camp.get('domain'),
+                name=camp.get('name'),
+                placement_type=camp.get('placementType'),
+                business_id=business.get('id'),
+                business_name=business.get('name'),
+            ))
+        return CampaignsResult(response=response, campaigns=campaigns)
+
+    async def get_goods_feedback(self, api_key: str, business_id: str, limit: int = 1,
+                                 page_token: str = None, reaction_status: str = 'NEED_REACTION',
+                                 paid: bool = False, timeout: float = None) -> FeedbackPage:
+        """
+        POST /v2/businesses/{businessId}/goods-feedback — страница отзывов.
+        """
+        params = {'limit': limit}
+        if page_token:
+            params['page_token'] = page_token
+        body = {
+            'reactionStatus': reaction_status,
+            'paid': paid
+        }
+        response = await self._request('POST', f'/v2/businesses/{business_id}/goods-feedback', api_key,
+                                       params=params, json=body, timeout=timeout,
+                                       quota='goods_feedback', scope=business_id)
+        if not response.ok:
+            return FeedbackPage(response=response)
+
+        result = response.data.get('result', {})
+        return FeedbackPage(
+            response=response,
+            feedbacks=result.get('feedbacks', []),
+            next_page_token=result.get('paging', {}).get('nextPageToken'),
+        )
+
+    async def get_order_item(self, api_key: str, campaign_id: int, order_id: int,
+                             timeout: float = None) -> OrderResult:
+        """
+        GET /campaigns/{campaignId}/orders/{orderId}.
+        В item — первый товар заказа или None, если заказ не найден в кампании.
+        """
+        response = await self._request('GET', f'/campaigns/{campaign_id}/orders/{order_id}', api_key,
+                                       timeout=timeout, quota='order', scope=campaign_id)
+        if not response.ok:
+            return OrderResult(response=response)
+        items = response.data.get('order', {}).get('items', [])
+        if not items:
+            return OrderResult(response=response)
+        return OrderResult(response=response,
+                           item=OrderItem(offer_id=items[0].get('offerId'), offer_name=items[0].get('offerName')))
+
+    async def update_feedback_comment(self, api_key: str, business_id: str, feedback_id: int,
+                                      text: str, timeout: float = None) -> YandexResponse:
+        """
+        POST /businesses/{businessId}/goods-feedback/comments/update — ответ на отзыв.
+        """
+        body = {
+            "feedbackId": feedback_id,
+            "comment": {
+                # id не указываем для создания нового комментария
+                "text": text
+            }
+        }
+        return await self._request('POST', f'/businesses/{business_id}/goods-feedback/comments/update',
+                                   api_key, json=body, timeout=timeout,
+                                   quota='goods_feedback_comments_update', scope=business_id,
+                                   idempotent=False)
+
+
+# Общий клиент для всего процесса бэкенда
+yandex_client = YandexMarketClient()